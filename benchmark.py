@@ -0,0 +1,261 @@
+#!/usr/bin/env python
+
+# Copyright (c) 2013 Philippe Gauthier
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Round-trip benchmarks for YamahaRemoteControl.
+
+Runs against the simulated receiver from yamahasim and reports, for each
+scenario, the number of HTTP requests the receiver saw and the wall time.
+With --micro, measures instead the CPU time spent building requests and
+parsing responses, without any network.
+
+--trace records the traffic of a run to a trace file, and --replay runs the
+scenarios against such a trace instead of the simulator, for instance one
+recorded with --address against real hardware.
+"""
+
+import optparse
+import time
+import xml.etree.ElementTree
+
+import yamahasim
+import yamaharemote
+import yamahatrace
+from yamaharemote import YamahaRemoteControl
+
+def find_line(remote, name):
+    for line, text in remote.get_menu():
+        if text == name:
+            return line
+    raise KeyError(name)
+
+def open_folder(remote, name):
+    remote.select_menu(find_line(remote, name))
+
+def bench_refresh_cold(connect):
+    remote = connect()
+    yield "refresh (cold)", remote.refresh
+
+def bench_refresh(connect):
+    remote = connect()
+    remote.refresh()
+    yield "refresh", remote.refresh
+
+def bench_get_menu(size):
+    def bench(connect):
+        remote = connect()
+        remote.refresh()
+        open_folder(remote, "%d Items" % size)
+        yield "get_menu (%d items)" % size, lambda: list(remote.get_menu())
+        yield "get_menu (%d items, again)" % size, \
+                lambda: list(remote.get_menu())
+    return bench
+
+def bench_select_menu(connect):
+    remote = connect()
+    remote.refresh()
+    line = find_line(remote, "Artists")
+    yield "select_menu", lambda: remote.select_menu(line)
+
+def bench_menu_return(connect):
+    remote = connect()
+    remote.refresh()
+    open_folder(remote, "Artists")
+    list(remote.get_menu())
+    remote.menu_return()
+    list(remote.get_menu())
+    open_folder(remote, "Artists")
+    def reload_parent():
+        remote.menu_return()
+        list(remote.get_menu())
+    yield "menu_return + get_menu", reload_parent
+
+def bench_set_source(connect):
+    remote = connect()
+    remote.refresh()
+    yield "set_source (USB)", lambda: remote.set_source("USB")
+    yield "set_source (TUNER)", lambda: remote.set_source("TUNER")
+    yield "set_source (SERVER)", lambda: remote.set_source("SERVER")
+
+BENCHMARKS = [
+    bench_refresh_cold,
+    bench_refresh,
+    bench_get_menu(10),
+    bench_get_menu(1000),
+    bench_get_menu(10000),
+    bench_select_menu,
+    bench_menu_return,
+    bench_set_source,
+]
+
+def slow_build(cmd, data, param):
+    return ('<?xml version="1.0" encoding="utf-8"?>'
+            '<YAMAHA_AV cmd="%s">%s</YAMAHA_AV>'
+            % (cmd, data.format(param=param)))
+
+def slow_list_info(body):
+    root = xml.etree.ElementTree.fromstring(body)
+    info = root.find("*/List_Info")
+    return info.find("Menu_Status").text == "Ready"
+
+def fast_list_info(body):
+    if not yamaharemote.is_menu_ready(body):
+        return False
+    root = yamaharemote.ET.fromstring(body)
+    return root[0].find("List_Info").findtext("Menu_Status") == "Ready"
+
+def slow_basic_status(body):
+    status = xml.etree.ElementTree.fromstring(body).find(
+            "Main_Zone/Basic_Status")
+    return status.find("Volume/Mute").text
+
+def fast_basic_status(body):
+    status = yamaharemote.ET.fromstring(body).find("Main_Zone/Basic_Status")
+    return status.findtext("Volume/Mute")
+
+def micro(options):
+    receiver = yamahasim.Receiver(busy_delay=3600)
+    def respond(data):
+        return receiver.handle(slow_build("GET", data, "SERVER"))
+    basic_status = respond(yamaharemote.BASIC_STATUS_REQ)
+    receiver.busy_delay = 0
+    receiver.handle(slow_build("PUT",
+            "<{param}><List_Control><Jump_Line>1</Jump_Line></List_Control>"
+            "</{param}>", "SERVER"))
+    ready = respond(yamaharemote.LIST_INFO_REQ)
+    receiver.busy_delay = 3600
+    receiver.handle(slow_build("PUT",
+            "<{param}><List_Control><Jump_Line>9</Jump_Line></List_Control>"
+            "</{param}>", "SERVER"))
+    busy = respond(yamaharemote.LIST_INFO_REQ)
+
+    cases = [
+        ("build request", slow_build, yamaharemote.build_request,
+            ("GET", yamaharemote.LIST_INFO_REQ, "SERVER")),
+        ("parse Basic_Status", slow_basic_status, fast_basic_status,
+            (basic_status,)),
+        ("parse List_Info (Ready)", slow_list_info, fast_list_info,
+            (ready,)),
+        ("parse List_Info (Busy)", slow_list_info, fast_list_info, (busy,)),
+    ]
+    print "%-32s %12s %12s" % ("operation", "before (us)", "after (us)")
+    for name, slow, fast, args in cases:
+        times = []
+        for func in (slow, fast):
+            start = time.clock()
+            for i in xrange(options.iterations):
+                func(*args)
+            times.append((time.clock() - start) / options.iterations * 1e6)
+        print "%-32s %12.1f %12.1f" % (name, times[0], times[1])
+
+class CountingTransport(object):
+    """Counts the requests made through another transport."""
+
+    def __init__(self, transport):
+        self.transport = transport
+        self.address = transport.address
+        self.request_count = 0
+
+    @property
+    def online(self):
+        return self.transport.online
+
+    def perform(self, cmd, req):
+        self.request_count += 1
+        return self.transport.perform(cmd, req)
+
+    def getinfo(self, info):
+        return self.transport.getinfo(info)
+
+    def probe(self):
+        return self.transport.probe()
+
+    def fetch(self, path):
+        return self.transport.fetch(path)
+
+    def close(self):
+        self.transport.close()
+
+def run(options):
+    receiver = server = None
+    if options.replay:
+        replay = yamahatrace.ReplayTransport(
+                yamahatrace.load_trace(options.replay), options.replay_speed)
+        transport = CountingTransport(replay)
+        address = replay.address
+    else:
+        address = options.address
+        if address is None:
+            receiver = yamahasim.Receiver(busy_delay=options.busy_delay,
+                    latency=options.latency,
+                    batching=not options.no_batching)
+            server = yamahasim.ReceiverServer(receiver)
+            server.start()
+            address = server.get_address()
+        transport = yamaharemote.CurlTransport(address)
+        if options.trace:
+            transport = yamahatrace.RecordingTransport(transport,
+                    yamahatrace.get_recorder(options.trace))
+        transport = CountingTransport(transport)
+
+    # All scenarios share one transport, so that a replay answers them in
+    # the order they were recorded.
+    def connect():
+        return YamahaRemoteControl(address, transport=transport)
+
+    print "%-32s %10s %10s" % ("scenario", "requests", "time (ms)")
+    for bench in BENCHMARKS:
+        if receiver is not None:
+            receiver.reset_menus()
+        for name, func in bench(connect):
+            count = transport.request_count
+            start = time.time()
+            func()
+            elapsed = time.time() - start
+            print "%-32s %10d %10.1f" % (name,
+                    transport.request_count - count, elapsed * 1000)
+    if server is not None:
+        server.shutdown()
+    if options.replay and replay.missing:
+        print "%d requests were not in the trace" % sum(
+                replay.missing.values())
+
+if __name__ == '__main__':
+    parser = optparse.OptionParser(usage="%prog [options]")
+    parser.add_option("--latency", type="float", default=0.0,
+            help="delay added to every request, in seconds")
+    parser.add_option("--busy-delay", type="float", default=0.0,
+            help="time the menu stays Busy after a list operation")
+    parser.add_option("--no-batching", action="store_true",
+            help="simulate firmware that rejects multi-node GET requests")
+    parser.add_option("--address",
+            help="benchmark this receiver instead of the simulator")
+    parser.add_option("--trace", metavar="FILE",
+            help="record the traffic to a trace file")
+    parser.add_option("--replay", metavar="FILE",
+            help="answer from a trace file instead of a receiver")
+    parser.add_option("--replay-speed", type="float",
+            help="replay at this multiple of the recorded speed "
+            "[default: as fast as possible]")
+    parser.add_option("--micro", action="store_true",
+            help="measure request building and response parsing only")
+    parser.add_option("--iterations", type="int", default=2000,
+            help="repetitions of each --micro operation")
+    options, args = parser.parse_args()
+    if options.micro:
+        micro(options)
+    else:
+        run(options)
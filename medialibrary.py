@@ -0,0 +1,227 @@
+# Copyright (c) 2013 Philippe Gauthier
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Searchable local index of the menus of the SERVER and USB sources.
+
+Entries are stored in SQLite with the path of line numbers leading to them
+from the top menu, so that a search hit can be selected directly with
+YamahaRemoteControl.select_path().
+"""
+
+import os
+import re
+import sqlite3
+import threading
+
+from yamaharemote import xdg_cache_dir
+
+def path_to_string(path):
+    return "/".join(str(line) for line in path)
+
+def string_to_path(string):
+    if not string:
+        return ()
+    return tuple(int(line) for line in string.split("/"))
+
+class MediaIndex(object):
+    """Index of menu entries, with full-text search when available."""
+
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS folders (
+                source TEXT, path TEXT, name TEXT, max_line INTEGER,
+                PRIMARY KEY (source, path));
+            CREATE TABLE IF NOT EXISTS entries (
+                id INTEGER PRIMARY KEY, source TEXT, path TEXT,
+                parent TEXT, name TEXT, is_folder INTEGER);
+            CREATE INDEX IF NOT EXISTS entries_parent
+                ON entries (source, parent);
+            """)
+        try:
+            self.db.execute("CREATE VIRTUAL TABLE IF NOT EXISTS entries_fts "
+                    "USING fts4(name)")
+            self.fts = True
+        except sqlite3.OperationalError:
+            self.fts = False
+        self.db.commit()
+
+    def get_folder(self, source, path):
+        """Return (name, max_line) of an indexed folder, or None."""
+        with self.lock:
+            return self.db.execute("SELECT name, max_line FROM folders "
+                    "WHERE source = ? AND path = ?",
+                    (source, path_to_string(path))).fetchone()
+
+    def get_subfolders(self, source, path):
+        with self.lock:
+            rows = self.db.execute("SELECT path FROM entries "
+                    "WHERE source = ? AND parent = ? AND is_folder "
+                    "ORDER BY id", (source, path_to_string(path))).fetchall()
+        return [string_to_path(row[0]) for row in rows]
+
+    def set_folder(self, source, path, name, max_line, entries):
+        """Replace the content of a folder.
+
+        entries is a list of (line, text, is_folder).  Everything that was
+        indexed below the folder is dropped, since line numbers may have
+        shifted.
+        """
+        parent = path_to_string(path)
+        prefix = parent + "/" if parent else ""
+        with self.lock:
+            # The folder's own entry belongs to its parent and is kept.
+            below = "source = ? AND path LIKE ? AND path != ?"
+            below_args = (source, prefix + "%", parent)
+            if self.fts:
+                self.db.execute("DELETE FROM entries_fts WHERE docid IN "
+                        "(SELECT id FROM entries WHERE %s)" % below,
+                        below_args)
+            self.db.execute("DELETE FROM entries WHERE %s" % below, below_args)
+            self.db.execute("DELETE FROM folders WHERE source = ? AND "
+                    "(path LIKE ? OR path = ?)", below_args)
+            self.db.execute("INSERT INTO folders VALUES (?, ?, ?, ?)",
+                    (source, parent, name, max_line))
+            for line, text, is_folder in entries:
+                cursor = self.db.execute("INSERT INTO entries "
+                        "(source, path, parent, name, is_folder) "
+                        "VALUES (?, ?, ?, ?, ?)",
+                        (source, path_to_string(path + (line,)), parent,
+                            text, is_folder))
+                if self.fts:
+                    self.db.execute("INSERT INTO entries_fts (docid, name) "
+                            "VALUES (?, ?)", (cursor.lastrowid, text))
+            self.db.commit()
+
+    def get_names(self, source, path):
+        """Return the names of the entries along path, or None."""
+        names = []
+        with self.lock:
+            for depth in range(1, len(path) + 1):
+                row = self.db.execute("SELECT name FROM entries "
+                        "WHERE source = ? AND path = ?",
+                        (source, path_to_string(path[:depth]))).fetchone()
+                if row is None:
+                    return None
+                names.append(row[0])
+        return names
+
+    def search(self, query, source=None, limit=50):
+        """Return up to limit (source, path, name, is_folder) hits."""
+        words = re.findall(r"\w+", query, re.UNICODE)
+        if not words:
+            return []
+        if self.fts:
+            sql = ("SELECT source, path, name, is_folder FROM entries "
+                    "WHERE id IN (SELECT docid FROM entries_fts "
+                    "WHERE name MATCH ?)")
+            args = [" ".join(word + "*" for word in words)]
+        else:
+            sql = "SELECT source, path, name, is_folder FROM entries WHERE 1"
+            args = []
+            for word in words:
+                sql += " AND name LIKE ?"
+                args.append("%" + word + "%")
+        if source is not None:
+            sql += " AND source = ?"
+            args.append(source)
+        sql += " ORDER BY is_folder DESC, name LIMIT ?"
+        args.append(limit)
+        with self.lock:
+            rows = self.db.execute(sql, args).fetchall()
+        return [(source, string_to_path(path), name, bool(is_folder))
+                for source, path, name, is_folder in rows]
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+def default_index_path(remote):
+    directory = xdg_cache_dir()
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    name = re.sub(r"[^\w.-]", "_", remote.address)
+    return os.path.join(directory, "library-%s.sqlite" % name)
+
+class MediaCrawler(object):
+    """Walks the menu tree of the current source into a MediaIndex.
+
+    This moves the receiver's menu, so it should run while nobody is
+    browsing.  crawl() runs the whole walk at once; steps() does it one
+    folder at a time, so that it can be resumed from the remote worker
+    with other requests served in between.  Folders whose name and
+    Max_Line did not change since the last crawl are not listed again, but
+    their sub-folders are still visited.  The walk stops early when it is
+    cancelled or the source changes.
+    """
+
+    def __init__(self, remote, index):
+        self.remote = remote
+        self.index = index
+        self.cancelled = False
+        self.listed = 0
+
+    def cancel(self):
+        self.cancelled = True
+
+    def crawl(self):
+        """Index the current source.  Returns the number of folders listed."""
+        for folder in self.steps():
+            pass
+        return self.listed
+
+    def steps(self):
+        """Index the current source, yielding after each folder."""
+        remote = self.remote
+        self.listed = 0
+        info = remote.menu_root()
+        self.source = remote.get_source()
+        for folder in self._crawl_folder((), info):
+            yield folder
+        if remote.get_source() == self.source:
+            remote.menu_root()
+
+    def _stopped(self):
+        return self.cancelled or self.remote.get_source() != self.source
+
+    def _crawl_folder(self, path, info):
+        if self._stopped():
+            return
+        source = self.source
+        name = info.find("Menu_Name").text
+        max_line = int(info.find("Cursor_Position/Max_Line").text)
+        if self.index.get_folder(source, path) == (name, max_line):
+            subfolders = self.index.get_subfolders(source, path)
+        else:
+            entries = []
+            for page in self.remote.get_menu_entry_pages():
+                for line, text, attribute in page:
+                    entries.append((line, text, attribute == "Container"))
+            self.index.set_folder(source, path, name, max_line, entries)
+            self.listed += 1
+            subfolders = [path + (line,)
+                    for line, text, is_folder in entries if is_folder]
+        yield path
+
+        for subfolder in subfolders:
+            if self._stopped():
+                return
+            self.remote.select_menu(subfolder[-1])
+            for folder in self._crawl_folder(subfolder,
+                    self.remote.wait_for_menu_info()):
+                yield folder
+            self.remote.menu_return()
+            self.remote.wait_for_menu_info()
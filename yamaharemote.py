@@ -17,14 +17,1394 @@
 
 import pycurl
 import cStringIO
-import xml.etree.ElementTree as ET
+try:
+    import xml.etree.cElementTree as ET
+except ImportError:
+    import xml.etree.ElementTree as ET
 import sys
 import time
-
-from gi.repository import GObject, Gtk, Pango
+import threading
+import traceback
+import Queue
+import collections
+import itertools
+import math
+import os
+import re
+import json
+import socket
+import optparse
+import SocketServer
+
+from gi.repository import GObject
 
 AMP_ADDRESS = "192.168.1.158"
 
+# Approximate memory used by cached menu pages, in bytes.
+MENU_CACHE_SIZE = 1024 * 1024
+
+# How long to wait for the menu to become ready, in seconds.
+MENU_DEADLINE = 2.0
+
+# Number of folders whose entry names -> line numbers are remembered.
+MENU_LINE_FOLDERS = 1024
+
+# Number of menu entries kept in the startup snapshot.
+SNAPSHOT_MENU_ITEMS = 64
+
+# Status polling intervals, in seconds: while the window is focused or the
+# user is interacting, the longest back-off when idle, and in standby.
+SYNC_ACTIVE_INTERVAL = 1.0
+SYNC_IDLE_INTERVAL = 30.0
+SYNC_STANDBY_INTERVAL = 60.0
+# How long after the last interaction polling stays at the active interval.
+SYNC_ACTIVITY_TIMEOUT = 10.0
+
+# Maximum number of volume changes sent per second while dragging.
+VOLUME_RATE = 10.0
+# Delay after the last volume change before reading back the actual level.
+VOLUME_SETTLE = 0.5
+# Maximum number of power, mute, input and play mode changes sent per
+# second; quicker changes of the same setting collapse to the last one.
+TOGGLE_RATE = 4.0
+
+# Request priorities, most urgent first.
+PRIORITY_USER = 0
+PRIORITY_SYNC = 1
+PRIORITY_MENU = 2
+
+GObject.threads_init()
+
+NETWORK_NAME_REQ = "<System><Misc><Network><Network_Name>GetParam</Network_Name></Network></Misc></System>"
+BASIC_STATUS_REQ = "<Main_Zone><Basic_Status>GetParam</Basic_Status></Main_Zone>"
+INPUT_SEL_ITEM_REQ = "<Main_Zone><Input><Input_Sel_Item>GetParam</Input_Sel_Item></Input></Main_Zone>"
+SHUFFLE_REQ = "<{param}><Play_Control><Play_Mode><Shuffle>GetParam</Shuffle></Play_Mode></Play_Control></{param}>"
+REPEAT_REQ = "<{param}><Play_Control><Play_Mode><Repeat>GetParam</Repeat></Play_Mode></Play_Control></{param}>"
+LIST_INFO_REQ = "<{param}><List_Info>GetParam</List_Info></{param}>"
+PLAYBACK_INFO_REQ = "<{param}><Play_Info><Playback_Info>GetParam</Playback_Info></Play_Info></{param}>"
+PLAY_TIME_REQ = "<{param}><Play_Info><Play_Time>GetParam</Play_Time></Play_Info></{param}>"
+META_INFO_REQ = "<{param}><Play_Info><Meta_Info>GetParam</Meta_Info></Play_Info></{param}>"
+ALBUM_ART_REQ = "<{param}><Play_Info><Album_ART>GetParam</Album_ART></Play_Info></{param}>"
+
+POWER_PUT = "<Main_Zone><Power_Control><Power>%s</Power></Power_Control></Main_Zone>"
+VOLUME_PUT = "<Main_Zone><Volume><Lvl><Val>%d</Val><Exp>1</Exp><Unit>dB</Unit></Lvl></Volume></Main_Zone>"
+MUTE_PUT = "<Main_Zone><Volume><Mute>%s</Mute></Volume></Main_Zone>"
+INPUT_SEL_PUT = "<Main_Zone><Input><Input_Sel>%s</Input_Sel></Input></Main_Zone>"
+SHUFFLE_PUT = "<{param}><Play_Control><Play_Mode><Shuffle>%s</Shuffle></Play_Mode></Play_Control></{param}>"
+REPEAT_PUT = "<{param}><Play_Control><Play_Mode><Repeat>%s</Repeat></Play_Mode></Play_Control></{param}>"
+
+# Deadlines per command, in seconds: (connect, read, overall).  The read
+# deadline is how long a transfer may go without receiving anything, and
+# is rounded up to whole seconds by libcurl.
+TRANSPORT_TIMEOUTS = {
+    "GET": (1.0, 2.0, 3.0),
+    "PUT": (1.0, 2.0, 5.0),
+}
+
+# Extra attempts for GET requests whose kept-alive connection was dropped.
+GET_RETRIES = 1
+
+# How long a receiver that stopped answering is left alone before trying
+# to connect again, in seconds; doubles at each failure up to the maximum.
+OFFLINE_PROBE_INTERVAL = 2.0
+OFFLINE_PROBE_MAX = 30.0
+OFFLINE_PROBE_TIMEOUT = 0.5
+
+# Number of request documents kept by build_request().
+REQUEST_CACHE_SIZE = 256
+
+# How long answers to GetParam requests for these nodes stay valid, in
+# seconds.  Other nodes are always fetched.
+CACHE_TTLS = {
+    "Network_Name": 3600.0,
+    "Input_Sel_Item": 3600.0,
+}
+
+# Zones besides Main_Zone a receiver may have.
+ZONES = ["Zone_2", "Zone_3", "Zone_4"]
+
+# Sources with shuffle and repeat modes.
+PLAY_MODE_SOURCES = ["USB", "iPod_USB", "SERVER"]
+
+# Sources that report what they play in Play_Info, and those of them that
+# report the elapsed time.
+PLAY_INFO_SOURCES = ["SERVER", "USB", "NET RADIO"]
+PLAY_TIME_SOURCES = ["SERVER", "USB"]
+# Longest time between status polls while something plays and is shown,
+# in seconds.  The elapsed time is interpolated in between.
+PLAY_INFO_INTERVAL = 5.0
+# How far the reported elapsed time may fall behind the interpolated one,
+# in seconds, before the track is taken to have changed.
+PLAY_TIME_TOLERANCE = 3.0
+# Number of album covers kept in memory per receiver.
+ALBUM_ART_CACHE_SIZE = 32
+
+def xdg_cache_dir():
+    cache_home = os.environ.get("XDG_CACHE_HOME") or \
+            os.path.expanduser("~/.cache")
+    return os.path.join(cache_home, "yamaharemote")
+
+def xdg_config_dir():
+    config_home = os.environ.get("XDG_CONFIG_HOME") or \
+            os.path.expanduser("~/.config")
+    return os.path.join(config_home, "yamaharemote")
+
+def load_config():
+    """Return the user configuration, an empty dictionary if there is none."""
+    try:
+        with open(os.path.join(xdg_config_dir(), "config.json")) as f:
+            return json.load(f)
+    except IOError:
+        return {}
+
+def save_config(config):
+    directory = xdg_config_dir()
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    path = os.path.join(directory, "config.json")
+    with open(path + ".tmp", "w") as f:
+        json.dump(config, f, indent=4, sort_keys=True)
+    os.rename(path + ".tmp", path)
+
+def get_receiver_zones(address, config=None):
+    """Return the zones besides Main_Zone in use on a receiver.
+
+    They are listed per address in the "zones" entry of the configuration.
+    """
+    if config is None:
+        config = load_config()
+    return [zone for zone in config.get("zones", {}).get(address, [])
+            if zone in ZONES]
+
+def for_zone(data, zone):
+    """Return a Main_Zone request template rewritten for another zone."""
+    if zone is None or zone == "Main_Zone":
+        return data
+    return data.replace("<Main_Zone>", "<%s>" % zone).replace(
+            "</Main_Zone>", "</%s>" % zone)
+
+def parse_basic_status(status):
+    """Return the settings in a Basic_Status node, keyed by property."""
+    level = status.find("Volume/Lvl")
+    return {
+        "power": status.findtext("Power_Control/Power") == "On",
+        "volume": int(level.findtext("Val")) /
+                10.0**int(level.findtext("Exp")),
+        "muted": status.findtext("Volume/Mute") == "On",
+        "source": status.findtext("Input/Input_Sel"),
+    }
+
+def get_receiver_addresses(config=None):
+    """Return the addresses in the "receivers" list of the configuration.
+
+    Without one, the single receiver at AMP_ADDRESS is used.
+    """
+    if config is None:
+        config = load_config()
+    return config.get("receivers") or [AMP_ADDRESS]
+
+def make_curl_share():
+    """Return a CurlShare for the handles of several remotes.
+
+    DNS answers are always shared, and the connection cache too when
+    libcurl and pycurl support it.
+    """
+    share = pycurl.CurlShare()
+    share.setopt(pycurl.SH_SHARE, pycurl.LOCK_DATA_DNS)
+    lock_data_connect = getattr(pycurl, "LOCK_DATA_CONNECT", None)
+    if lock_data_connect is not None:
+        try:
+            share.setopt(pycurl.SH_SHARE, lock_data_connect)
+        except pycurl.error:
+            pass
+    return share
+
+_request_cache = {}
+
+def build_request(cmd, data, param):
+    """Return the request document for a command template and Src_Name.
+
+    The same few documents are sent over and over, so they are memoized.
+    """
+    key = (cmd, data, param)
+    req = _request_cache.get(key)
+    if req is None:
+        if len(_request_cache) >= REQUEST_CACHE_SIZE:
+            _request_cache.clear()
+        req = ('<?xml version="1.0" encoding="utf-8"?>'
+                '<YAMAHA_AV cmd="%s">%s</YAMAHA_AV>'
+                % (cmd, data.format(param=param)))
+        _request_cache[key] = req
+    return req
+
+RC_RE = re.compile(r'<YAMAHA_AV[^>]* RC="(\d+)"')
+MENU_STATUS_RE = re.compile(r"<Menu_Status>([^<]*)</Menu_Status>")
+
+def is_menu_ready(body):
+    """Tell from a raw List_Info response whether the menu is ready.
+
+    Busy answers can then be dropped without being parsed.
+    """
+    match = MENU_STATUS_RE.search(body)
+    return match is None or match.group(1) == "Ready"
+
+def _merge_into(target, element):
+    for child in element:
+        existing = target.find(child.tag)
+        if existing is not None and len(existing) and len(child):
+            _merge_into(existing, child)
+        else:
+            target.append(child)
+
+def merge_requests(bodies):
+    """Merge several request bodies into one, sharing common parent nodes.
+
+    For example, Shuffle and Repeat requests for the same source become a
+    single <Play_Mode> node with both children.
+    """
+    root = ET.Element("YAMAHA_AV")
+    for body in bodies:
+        _merge_into(root, ET.fromstring("<YAMAHA_AV>%s</YAMAHA_AV>" % body))
+    return "".join(ET.tostring(child) for child in root)
+
+def request_paths(body):
+    """Return the paths of the leaf nodes queried by a request body."""
+    paths = []
+    def walk(element, path):
+        if len(element):
+            for child in element:
+                walk(child, path + [child.tag])
+        else:
+            paths.append("/".join(path))
+    walk(ET.fromstring("<YAMAHA_AV>%s</YAMAHA_AV>" % body), [])
+    return paths
+
+def _call_once(func, *args):
+    # Wrapper for GObject.idle_add() so that the callback's return value
+    # never causes it to be rescheduled.
+    func(*args)
+    return False
+
+def _notify(remote, obj, property_name):
+    # Property notifications are always emitted from the main loop, even
+    # when the state was changed by a request running on the worker.
+    # Without a worker, as in the command line and the daemon, there may
+    # be no main loop to run them, so they are emitted right away.
+    if (remote.worker is None or
+            threading.current_thread() is remote.main_thread):
+        GObject.GObject.notify(obj, property_name)
+    else:
+        GObject.idle_add(_call_once, GObject.GObject.notify, obj,
+                property_name)
+
+def _deliver(token, func, *args):
+    # Like _call_once(), but drops results of cancelled jobs.
+    if token is None or not token.cancelled:
+        func(*args)
+    return False
+
+class CancellationToken(object):
+    """Shared by related jobs so that they can be abandoned together.
+
+    Queued jobs with a cancelled token are skipped and their callbacks are
+    not called.  Long jobs may also check the cancelled attribute.
+    """
+
+    def __init__(self):
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+class RemoteWorker(threading.Thread):
+    """Runs remote control requests away from the main loop.
+
+    Jobs are executed one at a time, most urgent priority first and in
+    submission order within a priority.  Each job should leave the receiver
+    in a consistent state (a page fetch does its Jump_Line and List_Info in
+    the same job), since other jobs may run in between.  Results are handed
+    back to the main loop with GObject.idle_add().
+    """
+
+    def __init__(self):
+        threading.Thread.__init__(self, name="YamahaRemoteWorker")
+        self.daemon = True
+        self.queue = Queue.PriorityQueue()
+        self.sequence = itertools.count()
+
+    def submit(self, func, args, callback=None, error_callback=None,
+            priority=PRIORITY_USER, token=None):
+        self.queue.put((priority, next(self.sequence),
+                (func, args, callback, error_callback, token)))
+
+    def stop(self):
+        self.queue.put((-1, next(self.sequence), None))
+
+    def run(self):
+        while True:
+            priority, sequence, job = self.queue.get()
+            if job is None:
+                break
+            func, args, callback, error_callback, token = job
+            if token is not None and token.cancelled:
+                continue
+            try:
+                result = func(*args)
+            except Exception, e:
+                if error_callback is not None:
+                    GObject.idle_add(_deliver, token, error_callback, e)
+                elif not isinstance(e, ReceiverOfflineError):
+                    traceback.print_exc()
+                continue
+            if callback is not None:
+                GObject.idle_add(_deliver, token, callback, result)
+
+class Histogram(object):
+    """Counts values in power-of-two buckets.
+
+    Values are recorded as integers (microseconds or bytes), which keeps
+    recording down to a bit_length() and a dictionary increment.
+    """
+
+    def __init__(self):
+        self.buckets = collections.defaultdict(int)
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def add(self, value):
+        value = int(value)
+        self.buckets[value.bit_length()] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def mean(self):
+        if self.count == 0:
+            return 0.0
+        return float(self.total) / self.count
+
+    def percentile(self, fraction):
+        """Return the upper bound of the bucket holding the given fraction."""
+        wanted = fraction * self.count
+        seen = 0
+        for bits in sorted(self.buckets):
+            seen += self.buckets[bits]
+            if seen >= wanted:
+                return min(2 ** bits, self.max)
+        return self.max
+
+    def to_dict(self):
+        return {
+            "count": self.count,
+            "mean": self.mean(),
+            "p50": self.percentile(0.5),
+            "p90": self.percentile(0.9),
+            "p99": self.percentile(0.99),
+            "max": self.max,
+            "buckets": dict((2 ** bits, n) for bits, n in self.buckets.items()),
+        }
+
+class CommandStats(object):
+    def __init__(self):
+        self.count = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.connect_time = Histogram()
+        self.total_time = Histogram()
+        self.parse_time = Histogram()
+        self.connections = 0
+        self.errors = collections.defaultdict(int)
+
+class RequestStats(object):
+    """Per-command request counters and timing histograms.
+
+    Commands are identified by the request type and the first two levels of
+    the request body, for instance ("GET", "Main_Zone/Basic_Status"); the
+    kind of a merged request joins those of its parts with "+".  Times are
+    in microseconds.  Errors are counted by RC, or as "curl N" for
+    transfers that failed with curl error N.  Listeners are called as
+    listener(cmd, kind, total_time, error_code) after each request, from
+    the thread that made it, with total_time in seconds.
+    """
+
+    TAG_RE = re.compile(r"<(/?)([^<>/]+)(/?)>")
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.commands = collections.defaultdict(CommandStats)
+        self.kinds = {}
+        self.log_thread = None
+        self.listeners = []
+
+    def kind(self, data):
+        kind = self.kinds.get(data)
+        if kind is None:
+            kinds = []
+            depth = 0
+            for match in self.TAG_RE.finditer(data):
+                closing, tag, empty = match.groups()
+                if closing:
+                    depth -= 1
+                    continue
+                if depth == 0:
+                    top = tag
+                elif depth == 1 and top + "/" + tag not in kinds:
+                    kinds.append(top + "/" + tag)
+                if not empty:
+                    depth += 1
+            kind = "+".join(kinds) or data[:40]
+            if len(self.kinds) > 256:
+                self.kinds.clear()
+            self.kinds[data] = kind
+        return kind
+
+    def record(self, cmd, data, sent, received, connect_time, total_time,
+            parse_time, error_code, connections=0):
+        key = (cmd, self.kind(data))
+        with self.lock:
+            stats = self.commands[key]
+            stats.count += 1
+            stats.connections += connections
+            stats.bytes_sent += sent
+            stats.bytes_received += received
+            stats.connect_time.add(connect_time * 1e6)
+            stats.total_time.add(total_time * 1e6)
+            stats.parse_time.add(parse_time * 1e6)
+            if error_code != 0:
+                stats.errors[error_code] += 1
+        for listener in self.listeners:
+            listener(cmd, key[1], total_time, error_code)
+
+    def request_count(self):
+        with self.lock:
+            return sum(stats.count for stats in self.commands.values())
+
+    def snapshot(self):
+        """Return the statistics as plain dictionaries, keyed by command."""
+        with self.lock:
+            result = {}
+            for (cmd, kind), stats in self.commands.items():
+                result["%s %s" % (cmd, kind)] = {
+                    "count": stats.count,
+                    "bytes_sent": stats.bytes_sent,
+                    "bytes_received": stats.bytes_received,
+                    "connect_time": stats.connect_time.to_dict(),
+                    "total_time": stats.total_time.to_dict(),
+                    "parse_time": stats.parse_time.to_dict(),
+                    "connections": stats.connections,
+                    "errors": dict(stats.errors),
+                }
+            return result
+
+    def reset(self):
+        with self.lock:
+            self.commands.clear()
+
+    def dump(self, out=sys.stderr):
+        snapshot = self.snapshot()
+        print >>out, "%-40s %6s %6s %9s %9s %9s %9s %9s %s" % ("command",
+                "count", "conns", "sent", "received", "total ms", "p90 ms",
+                "parse ms", "errors")
+        for key in sorted(snapshot):
+            stats = snapshot[key]
+            print >>out, "%-40s %6d %6d %9d %9d %9.1f %9.1f %9.2f %s" % (key,
+                    stats["count"], stats["connections"], stats["bytes_sent"],
+                    stats["bytes_received"],
+                    stats["total_time"]["mean"] / 1000.0,
+                    stats["total_time"]["p90"] / 1000.0,
+                    stats["parse_time"]["mean"] / 1000.0,
+                    stats["errors"] or "")
+
+    def start_logging(self, interval, out=sys.stderr):
+        """Dump the statistics every interval seconds from a daemon thread."""
+        if self.log_thread is not None:
+            return
+        def log():
+            while True:
+                time.sleep(interval)
+                self.dump(out)
+        self.log_thread = threading.Thread(target=log,
+                name="YamahaRemoteStats")
+        self.log_thread.daemon = True
+        self.log_thread.start()
+
+class LatestValueSender(object):
+    """Sends the latest value of a setting, one request at a time.
+
+    At most one request is in flight and one value is pending; a new value
+    replaces the pending one, so intermediate values are never sent.
+    Requests are spaced to at most rate per second.  Once no new value has
+    been set for settle seconds, on_settled() is called, for instance to
+    read back what the receiver actually applied.
+
+    If a request fails, on_failed(value, error) is called.
+
+    Without a worker, or from another thread than the main loop's, values
+    are sent immediately.
+    """
+
+    def __init__(self, remote, send, on_sent, rate, settle=None,
+            on_settled=None, on_failed=None):
+        self.remote = remote
+        self.send = send
+        self.on_sent = on_sent
+        self.interval = 1.0 / rate
+        self.settle = settle
+        self.on_settled = on_settled
+        self.on_failed = on_failed
+        self.pending = None
+        self.in_flight = False
+        self.sending = None
+        self.last_sent = 0.0
+        self.timer_id = None
+        self.settle_id = None
+
+    def is_busy(self):
+        return self.in_flight or self.pending is not None
+
+    def set(self, value):
+        if (self.remote.worker is None or
+                threading.current_thread() is not self.remote.main_thread):
+            try:
+                self.send(value)
+            except Exception, e:
+                if self.on_failed is not None:
+                    self.on_failed(value, e)
+                raise
+            self.on_sent(value)
+            return
+        self.pending = value
+        if self.settle_id is not None:
+            GObject.source_remove(self.settle_id)
+            self.settle_id = None
+        self._schedule()
+
+    def cancel(self):
+        """Drop the value waiting to be sent, if any."""
+        self.pending = None
+        if self.timer_id is not None:
+            GObject.source_remove(self.timer_id)
+            self.timer_id = None
+
+    def _schedule(self):
+        if self.in_flight or self.timer_id is not None or self.pending is None:
+            return
+        wait = self.last_sent + self.interval - time.time()
+        if wait > 0:
+            self.timer_id = GObject.timeout_add(int(wait * 1000) + 1,
+                    self._on_timer)
+        else:
+            self._send()
+
+    def _on_timer(self):
+        self.timer_id = None
+        self._schedule()
+        return False
+
+    def _send(self):
+        value = self.pending
+        self.pending = None
+        self.in_flight = True
+        self.sending = value
+        self.last_sent = time.time()
+        self.remote.call_async(self.send, value, priority=PRIORITY_USER,
+                callback=lambda result: self._on_done(value, None),
+                error_callback=lambda error: self._on_done(value, error))
+
+    def _on_done(self, value, error):
+        self.in_flight = False
+        self.sending = None
+        if error is not None:
+            print >>sys.stderr, "Warning: %s" % error
+            if self.on_failed is not None:
+                self.on_failed(value, error)
+        else:
+            self.on_sent(value)
+        self._schedule()
+        if not self.is_busy() and self.on_settled is not None:
+            self.settle_id = GObject.timeout_add(int(self.settle * 1000),
+                    self._on_settle)
+
+    def _on_settle(self):
+        self.settle_id = None
+        self.on_settled()
+        return False
+
+class OptimisticSetting(object):
+    """A setting that shows new values before the receiver confirms them.
+
+    set() changes attribute attr of state and notifies name at once, then
+    sends the value with a LatestValueSender, so that values set in quick
+    succession collapse to the last one, and going back to the value the
+    receiver has cancels what was not sent yet.  If the request fails, or
+    the receiver refuses it, the confirmed value is shown again unless a
+    newer one is on its way.
+
+    Without a worker, or from another thread than the main loop's, set()
+    blocks, and raises errors after rolling back.
+    """
+
+    def __init__(self, remote, state, name, attr, send):
+        self.state = state
+        self.name = name
+        self.attr = attr
+        self.confirmed = None
+        # (value, callback) waiting for value to be applied.
+        self.callbacks = []
+        self.sender = LatestValueSender(remote, send, self._on_sent,
+                TOGGLE_RATE, on_failed=self._on_failed)
+
+    def is_busy(self):
+        return self.sender.is_busy()
+
+    def _show(self, value):
+        if value != getattr(self.state, self.attr):
+            setattr(self.state, self.attr, value)
+            self.state.notify(self.name)
+
+    def set(self, value, callback=None):
+        """Show and send value.
+
+        If given, callback(value) is called once the receiver applied it.
+        """
+        sender = self.sender
+        if not sender.is_busy():
+            self.confirmed = getattr(self.state, self.attr)
+        # What the receiver will have once the request in flight is done.
+        expected = sender.sending if sender.in_flight else self.confirmed
+        self._show(value)
+        self.callbacks = [item for item in self.callbacks if item[0] == value]
+        if value == expected:
+            sender.cancel()
+            if not sender.in_flight:
+                if callback is not None:
+                    callback(value)
+                return
+        if callback is not None:
+            self.callbacks.append((value, callback))
+        if value != expected:
+            sender.set(value)
+
+    def _take_callbacks(self, value):
+        callbacks = [item[1] for item in self.callbacks if item[0] == value]
+        self.callbacks = [item for item in self.callbacks
+                if item[0] == self.sender.pending]
+        return callbacks
+
+    def _on_sent(self, value):
+        self.confirmed = value
+        for callback in self._take_callbacks(value):
+            callback(value)
+
+    def _on_failed(self, value, error):
+        self._take_callbacks(value)
+        if not self.sender.is_busy():
+            self._show(self.confirmed)
+
+class StateSync(object):
+    """Keeps the state up to date with changes made by other controllers.
+
+    Basic_Status is polled from the main loop, every SYNC_ACTIVE_INTERVAL
+    while the window is focused or the user is interacting, and backing
+    off exponentially up to SYNC_IDLE_INTERVAL otherwise.  While the
+    receiver is in standby, with Main_Zone and every other zone off, it is
+    only polled when the window is active, and then slowly.  Only actual
+    changes cause notifications, and play modes are only queried when the
+    source changed.
+    """
+
+    def __init__(self, remote):
+        self.remote = remote
+        self.active = False
+        self.last_activity = 0.0
+        self.interval = SYNC_ACTIVE_INTERVAL
+        self.timer_id = None
+        self.in_flight = False
+        self.running = False
+
+    def start(self):
+        self.running = True
+        self._schedule(self._next_interval())
+
+    def stop(self):
+        self.running = False
+        self._cancel()
+
+    def set_active(self, active):
+        """Tell whether the user is looking at the remote (e.g. focus)."""
+        self.active = active
+        if active:
+            self.touch()
+
+    def touch(self):
+        """Record a user interaction; polls soon and keeps polling often."""
+        self.last_activity = time.time()
+        self.interval = SYNC_ACTIVE_INTERVAL
+        if self.running and not self.in_flight:
+            self._schedule(self.interval)
+
+    def _cancel(self):
+        if self.timer_id is not None:
+            GObject.source_remove(self.timer_id)
+            self.timer_id = None
+
+    def _schedule(self, interval):
+        self._cancel()
+        if interval is not None:
+            self.timer_id = GObject.timeout_add(int(interval * 1000),
+                    self._poll)
+
+    def _poll(self):
+        self.timer_id = None
+        self.in_flight = True
+        self.remote.call_async(self.remote.sync_status, priority=PRIORITY_SYNC,
+                callback=self._on_polled,
+                error_callback=self._on_error)
+        return False
+
+    def _on_polled(self, changed):
+        self.in_flight = False
+        if changed:
+            self.interval = SYNC_ACTIVE_INTERVAL
+        if self.running:
+            self._schedule(self._next_interval())
+
+    def _on_error(self, error):
+        if not isinstance(error, ReceiverOfflineError):
+            print >>sys.stderr, "Warning: %s" % error
+        self._on_polled(False)
+
+    def _in_standby(self):
+        remote = self.remote
+        return not remote.get_is_power_on() and not any(
+                zone.is_power_on for zone in remote.zones.values())
+
+    def _next_interval(self):
+        if not self.remote.is_online():
+            # Keep polling, if slowly, to find out when it is back.
+            return SYNC_IDLE_INTERVAL
+        if self._in_standby():
+            if self.active:
+                return SYNC_STANDBY_INTERVAL
+            return None
+        interacting = time.time() - self.last_activity < SYNC_ACTIVITY_TIMEOUT
+        if self.active or interacting:
+            # Changes made with the IR remote show up while looking.
+            return SYNC_ACTIVE_INTERVAL
+        interval = self.interval
+        self.interval = min(self.interval * 2, SYNC_IDLE_INTERVAL)
+        play_info = self.remote.play_info
+        if play_info.is_polled() and play_info.playback != "Stop":
+            # Catch track changes reasonably soon.
+            interval = min(interval, PLAY_INFO_INTERVAL)
+        return interval
+
+class ResponseCache(object):
+    """Memoizes responses to GET requests for nodes that rarely change.
+
+    Responses are keyed by request body and kept for the shortest TTL in
+    CACHE_TTLS of the nodes the body asks for.  The cache is cleared
+    whenever the receiver may have changed under us, such as on power
+    changes and errors.
+    """
+
+    LEAF_RE = re.compile(r"<([^<>/]+)>GetParam<")
+
+    def __init__(self, ttls=CACHE_TTLS):
+        self.ttls = ttls
+        self.entries = {}
+        self.body_ttls = {}
+        self.hits = 0
+        self.misses = 0
+
+    def ttl(self, body):
+        ttl = self.body_ttls.get(body)
+        if ttl is None:
+            nodes = self.LEAF_RE.findall(body)
+            ttl = min([self.ttls.get(node, 0.0) for node in nodes] or [0.0])
+            self.body_ttls[body] = ttl
+        return ttl
+
+    def get(self, body):
+        if self.ttl(body) <= 0:
+            return None
+        entry = self.entries.get(body)
+        if entry is not None and entry[0] > time.time():
+            self.hits += 1
+            return entry[1]
+        self.misses += 1
+        return None
+
+    def put(self, body, root):
+        ttl = self.ttl(body)
+        if ttl > 0 and root.get("RC") == "0":
+            self.entries[body] = (time.time() + ttl, root)
+
+    def invalidate(self, node=None):
+        """Forget the responses for node, or everything."""
+        if node is None:
+            self.entries.clear()
+            return
+        for body in self.entries.keys():
+            if node in self.LEAF_RE.findall(body):
+                del self.entries[body]
+
+class ReceiverOfflineError(pycurl.error):
+    """Raised instead of contacting a receiver that recently did not answer."""
+
+    # Unlike other pycurl errors, nothing was sent.
+    sent = False
+
+class CurlTransport(object):
+    """The HTTP connection to one receiver.
+
+    The connection is kept alive between requests, with TCP_NODELAY and TCP
+    keep-alive probes, and every request is bounded by the deadlines of its
+    command in TRANSPORT_TIMEOUTS.  GET requests, which can safely be
+    repeated, are retried when the kept-alive connection turns out to be
+    dropped.  When the receiver cannot be reached, it is marked offline:
+    requests then fail at once with ReceiverOfflineError, and at most every
+    probe interval a plain TCP connection is attempted to find out whether
+    it is back.
+    """
+
+    # Errors from a kept-alive connection the receiver closed.
+    RETRY_ERRORS = frozenset([pycurl.E_GOT_NOTHING, pycurl.E_SEND_ERROR,
+            pycurl.E_RECV_ERROR, pycurl.E_PARTIAL_FILE])
+    OFFLINE_ERRORS = frozenset([pycurl.E_COULDNT_CONNECT,
+            pycurl.E_OPERATION_TIMEDOUT, pycurl.E_COULDNT_RESOLVE_HOST])
+
+    def __init__(self, address, share=None, on_online_changed=None):
+        self.address = address
+        self.timeouts = TRANSPORT_TIMEOUTS
+        self.retries = GET_RETRIES
+        self.on_online_changed = on_online_changed
+        self.online = True
+        self.probe_time = 0.0
+        self.probe_interval = OFFLINE_PROBE_INTERVAL
+
+        self.curl = pycurl.Curl()
+        self.curl.setopt(pycurl.POST, 1)
+        self.curl.setopt(pycurl.URL,
+                "http://%s/YamahaRemoteControl/ctrl" % address)
+        self.curl.setopt(pycurl.HTTPHEADER,
+                ['Content-Type: text/xml; charset="utf-8"', 'Expect:',
+                    'Connection: keep-alive'])
+        # Timeouts must not rely on signals, which only work in the main
+        # thread.
+        self.curl.setopt(pycurl.NOSIGNAL, 1)
+        self.curl.setopt(pycurl.TCP_NODELAY, 1)
+        self.curl.setopt(pycurl.TCP_KEEPALIVE, 1)
+        self.curl.setopt(pycurl.TCP_KEEPIDLE, 30)
+        self.curl.setopt(pycurl.TCP_KEEPINTVL, 10)
+        self.curl.setopt(pycurl.LOW_SPEED_LIMIT, 1)
+        if share is not None:
+            self.curl.setopt(pycurl.SHARE, share)
+
+    def close(self):
+        self.curl.close()
+
+    def perform(self, cmd, req):
+        """Send a request document and return the response body.
+
+        Raises pycurl.error, or ReceiverOfflineError while the receiver is
+        offline.
+        """
+        if not self.online and not self.probe():
+            raise ReceiverOfflineError(pycurl.E_COULDNT_CONNECT,
+                    "%s is offline" % self.address)
+        connect, read, total = self.timeouts[cmd]
+        self.curl.setopt(pycurl.CONNECTTIMEOUT_MS, int(connect * 1000))
+        self.curl.setopt(pycurl.LOW_SPEED_TIME, int(math.ceil(read)))
+        self.curl.setopt(pycurl.TIMEOUT_MS, int(total * 1000))
+        self.curl.setopt(pycurl.POSTFIELDS, req)
+        attempts = 1 + (self.retries if cmd == "GET" else 0)
+        for attempt in range(attempts):
+            b = cStringIO.StringIO()
+            self.curl.setopt(pycurl.WRITEFUNCTION, b.write)
+            try:
+                self.curl.perform()
+            except pycurl.error, e:
+                if e.args[0] in self.OFFLINE_ERRORS:
+                    self._set_online(False)
+                    raise
+                if e.args[0] not in self.RETRY_ERRORS or \
+                        attempt == attempts - 1:
+                    raise
+                continue
+            self._set_online(True)
+            return b.getvalue()
+
+    def getinfo(self, info):
+        return self.curl.getinfo(info)
+
+    def fetch(self, path):
+        """Download a file the receiver serves, such as album art.
+
+        Returns None if the receiver does not have it.  This uses its own
+        connection, so it does not disturb the one kept alive for requests.
+        """
+        if not self.online:
+            raise ReceiverOfflineError(pycurl.E_COULDNT_CONNECT,
+                    "%s is offline" % self.address)
+        connect, read, total = self.timeouts["GET"]
+        curl = pycurl.Curl()
+        b = cStringIO.StringIO()
+        try:
+            curl.setopt(pycurl.URL, "http://%s%s" % (self.address, path))
+            curl.setopt(pycurl.NOSIGNAL, 1)
+            curl.setopt(pycurl.CONNECTTIMEOUT_MS, int(connect * 1000))
+            curl.setopt(pycurl.TIMEOUT_MS, int(total * 1000))
+            curl.setopt(pycurl.WRITEFUNCTION, b.write)
+            curl.perform()
+            if curl.getinfo(pycurl.RESPONSE_CODE) != 200:
+                return None
+        finally:
+            curl.close()
+        return b.getvalue()
+
+    def probe(self):
+        """Try to reach an offline receiver, if it is time to.
+
+        Returns True when it accepted a connection.
+        """
+        now = time.time()
+        if now < self.probe_time:
+            return False
+        host, sep, port = self.address.partition(":")
+        try:
+            sock = socket.create_connection((host, int(port or 80)),
+                    OFFLINE_PROBE_TIMEOUT)
+            sock.close()
+        except (socket.error, ValueError):
+            self.probe_time = now + self.probe_interval
+            self.probe_interval = min(self.probe_interval * 2,
+                    OFFLINE_PROBE_MAX)
+            return False
+        self._set_online(True)
+        return True
+
+    def _set_online(self, online):
+        if online:
+            self.probe_interval = OFFLINE_PROBE_INTERVAL
+        else:
+            self.probe_time = time.time() + self.probe_interval
+        if online != self.online:
+            self.online = online
+            if self.on_online_changed is not None:
+                self.on_online_changed(online)
+
+def make_transport(address, share=None, on_online_changed=None):
+    """Return the transport to use for a receiver.
+
+    This is a CurlTransport, unless the environment asks for a replay of the
+    trace in YAMAHAREMOTE_REPLAY (at YAMAHAREMOTE_REPLAY_SPEED times the
+    recorded speed, or as fast as possible), or for the traffic to be
+    recorded to YAMAHAREMOTE_TRACE.  See yamahatrace.
+    """
+    replay = os.environ.get("YAMAHAREMOTE_REPLAY")
+    if replay:
+        import yamahatrace
+        speed = os.environ.get("YAMAHAREMOTE_REPLAY_SPEED")
+        return yamahatrace.ReplayTransport(
+                yamahatrace.load_trace(replay, address),
+                float(speed) if speed else None, address)
+    transport = CurlTransport(address, share, on_online_changed)
+    trace = os.environ.get("YAMAHAREMOTE_TRACE")
+    if trace:
+        import yamahatrace
+        transport = yamahatrace.RecordingTransport(transport,
+                yamahatrace.get_recorder(trace))
+    return transport
+
+class MenuTimeoutError(Exception):
+    pass
+
+class RequestRefusedError(Exception):
+    """The receiver answered a PUT with a non-zero RC."""
+
+    def __init__(self, data, error_code):
+        Exception.__init__(self, "request refused with RC %d" % error_code)
+        self.data = data
+        self.error_code = error_code
+
+class ReadinessWaiter(object):
+    """Polls until the receiver reports that it is ready.
+
+    The first retry comes quickly and the delay then grows exponentially.
+    The time each key (usually the source) took to become ready is
+    remembered, and the typical delay is used to skip retries that are
+    bound to fail on slow sources.
+    """
+
+    def __init__(self, deadline=MENU_DEADLINE, first_delay=0.01,
+            factor=2.0, max_delay=0.25):
+        self.deadline = deadline
+        self.first_delay = first_delay
+        self.factor = factor
+        self.max_delay = max_delay
+        self.typical = {}
+        self.waits = collections.defaultdict(
+                lambda: collections.deque(maxlen=100))
+
+    def delays(self, key):
+        delay = max(self.first_delay, self.typical.get(key, 0.0) / 2.0)
+        while True:
+            yield min(delay, self.max_delay)
+            delay *= self.factor
+
+    def record(self, key, elapsed):
+        self.waits[key].append(elapsed)
+        typical = self.typical.get(key, elapsed)
+        self.typical[key] = 0.75 * typical + 0.25 * elapsed
+
+    def wait(self, key, poll, deadline=None):
+        """Call poll() until it returns something other than None."""
+        if deadline is None:
+            deadline = self.deadline
+        start = time.time()
+        delays = self.delays(key)
+        while True:
+            result = poll()
+            elapsed = time.time() - start
+            if result is not None:
+                self.record(key, elapsed)
+                return result
+            delay = min(next(delays), deadline - elapsed)
+            if delay <= 0:
+                self.record(key, elapsed)
+                raise MenuTimeoutError("%s not ready after %.2f s" % (key, elapsed))
+            time.sleep(delay)
+
+class MenuPageCache(object):
+    """Least recently used cache of menu list pages.
+
+    Each page is stored with the Max_Line of the list it was read from; a
+    page is only returned while the list still has the same length, so
+    folders whose content changed are refetched lazily.  The cache is
+    bounded by an estimate of the memory held by the page texts.
+    """
+
+    # Rough per-item overhead of the tuple and the line number.
+    ITEM_SIZE = 64
+
+    def __init__(self, max_size=MENU_CACHE_SIZE):
+        self.max_size = max_size
+        self.size = 0
+        self.pages = collections.OrderedDict()
+
+    def get(self, key, max_line):
+        entry = self.pages.pop(key, None)
+        if entry is None:
+            return None
+        if entry[0] != max_line:
+            self.size -= entry[2]
+            return None
+        self.pages[key] = entry
+        return entry[1]
+
+    def put(self, key, max_line, items):
+        self.discard(key)
+        size = sum(self.ITEM_SIZE + len(item[1]) for item in items)
+        self.pages[key] = (max_line, items, size)
+        self.size += size
+        while self.size > self.max_size and self.pages:
+            old_key, entry = self.pages.popitem(last=False)
+            self.size -= entry[2]
+
+    def discard(self, key):
+        entry = self.pages.pop(key, None)
+        if entry is not None:
+            self.size -= entry[2]
+
+    def discard_folder(self, folder):
+        for key in [key for key in self.pages if key[0] == folder]:
+            self.discard(key)
+
+    def clear(self):
+        self.pages.clear()
+        self.size = 0
+
+class PlayInfo(GObject.GObject):
+    """What the current input plays, from its Play_Info.
+
+    Polling asks for Playback_Info and Play_Time only, and the elapsed time
+    is interpolated in between.  Meta_Info and Album_ART are fetched again
+    when the track seems to have changed: when playback starts, or when the
+    elapsed time falls behind the interpolated one.  Inputs without
+    Play_Time, such as NET RADIO, are polled for Meta_Info instead.  Album
+    art is downloaded once per cover and kept in memory.
+
+    Play_Info is only polled while watched, which the GUI sets while its
+    window is visible, and while a PLAY_INFO_SOURCES input is selected.
+    """
+
+    __gproperties__ = {
+        "playback": (str, "playback",
+                     "Play, Pause or Stop",
+                     "",
+                     GObject.PARAM_READABLE),
+        "artist": (str, "artist",
+                   "Artist or station",
+                   "",
+                   GObject.PARAM_READABLE),
+        "album": (str, "album",
+                  "Album",
+                  "",
+                  GObject.PARAM_READABLE),
+        "song": (str, "song",
+                 "Song",
+                 "",
+                 GObject.PARAM_READABLE),
+        "art": (object, "art",
+                "Album art image data, or None",
+                GObject.PARAM_READABLE),
+        }
+
+    META_ATTRS = ("artist", "album", "song")
+
+    def __init__(self, remote):
+        GObject.GObject.__init__(self)
+        self.remote = remote
+        self.watched = False
+        self.playback = "Stop"
+        self.artist = None
+        self.album = None
+        self.song = None
+        self.art = None
+        self.art_key = None
+        # (url, ID) -> image data, least recently used first.
+        self.art_cache = collections.OrderedDict()
+        self.elapsed = None
+        self.elapsed_time = 0.0
+        # Whether the metadata and art of the track still have to be
+        # fetched, for instance because the last attempt failed.
+        self.fetch_pending = False
+
+    def notify(self, property_name):
+        _notify(self.remote, self, property_name)
+
+    def do_get_property(self, prop):
+        if prop.name == 'art':
+            return self.art
+        elif prop.name in ('playback',) + self.META_ATTRS:
+            return getattr(self, prop.name) or ""
+        else:
+            raise AttributeError, "Unknown property %s" % prop.name
+
+    def set_watched(self, watched):
+        """Tell whether what is playing is being shown."""
+        self.watched = watched
+        if watched:
+            self.remote.sync.touch()
+
+    def is_polled(self):
+        remote = self.remote
+        return (self.watched and remote.is_power_on and
+                remote.source in PLAY_INFO_SOURCES)
+
+    def get_elapsed(self):
+        """Return the elapsed time of the track in seconds, or None."""
+        if self.elapsed is None:
+            return None
+        if self.playback != "Play":
+            return self.elapsed
+        return self.elapsed + int(time.time() - self.elapsed_time)
+
+    def _set(self, name, value):
+        if value != getattr(self, name):
+            setattr(self, name, value)
+            self.notify(name)
+            return True
+        return False
+
+    def update(self, playback, elapsed):
+        """Apply a poll.  Returns True if the metadata must be fetched again.
+
+        elapsed is None for inputs without Play_Time.
+        """
+        track_changed = playback != "Stop" and (self.song is None or
+                self.playback == "Stop")
+        if elapsed is not None and self.elapsed is not None:
+            expected = self.get_elapsed()
+            if elapsed < expected - PLAY_TIME_TOLERANCE:
+                track_changed = True
+        self.elapsed = elapsed
+        self.elapsed_time = time.time()
+        self._set("playback", playback)
+        if playback == "Stop":
+            self.clear_meta()
+            self.fetch_pending = False
+        elif track_changed:
+            self.fetch_pending = True
+        return self.fetch_pending
+
+    def update_meta(self, meta):
+        """Apply a Meta_Info node.  Returns the names of changed properties."""
+        values = {
+            "artist": meta.findtext("Artist") or meta.findtext("Station"),
+            "album": meta.findtext("Album"),
+            "song": meta.findtext("Song"),
+        }
+        return [name for name in self.META_ATTRS
+                if self._set(name, values[name])]
+
+    def clear_meta(self):
+        for name in self.META_ATTRS:
+            self._set(name, None)
+        self.set_art(None, None)
+
+    def set_art(self, key, art):
+        self.art_key = key
+        self._set("art", art)
+
+    def reset(self):
+        """Forget everything, for instance when the input changed."""
+        self.elapsed = None
+        self.fetch_pending = False
+        self._set("playback", "Stop")
+        self.clear_meta()
+
+    def get_art(self, key):
+        """Return cached image data for key, or None."""
+        art = self.art_cache.get(key)
+        if art is not None:
+            self.art_cache[key] = self.art_cache.pop(key)
+        return art
+
+    def put_art(self, key, art):
+        self.art_cache[key] = art
+        while len(self.art_cache) > ALBUM_ART_CACHE_SIZE:
+            self.art_cache.popitem(last=False)
+
+class ZoneState(GObject.GObject):
+    """The state of a zone besides Main_Zone.
+
+    YamahaRemoteControl updates it with the zone's own Basic_Status, polled
+    along with that of Main_Zone, and it notifies its own properties, only
+    when they change.  The setters and
+    getters mirror those of YamahaRemoteControl, so commands can be given a
+    zone instead of the remote.
+    """
+
+    __gproperties__ = {
+        "volume": (float, "volume",
+                   "Output volume",
+                   -80.0, 16.0, -40.0,
+                   GObject.PARAM_READABLE),
+        "muted": (bool, "muted",
+                  "Is audio muted",
+                  False,
+                  GObject.PARAM_READABLE),
+        "power": (bool, "power",
+                  "Is the zone powered up",
+                  False,
+                  GObject.PARAM_READABLE),
+        "source": (str, "source",
+                   "Selected input device",
+                   "",
+                   GObject.PARAM_READABLE),
+        }
+
+    # Property name -> attribute.
+    ATTRS = {
+        "power": "is_power_on",
+        "volume": "volume",
+        "muted": "is_muted",
+        "source": "source",
+    }
+
+    def __init__(self, remote, zone):
+        GObject.GObject.__init__(self)
+        self.remote = remote
+        self.zone = zone
+        self.is_power_on = False
+        self.volume = -40.0
+        self.is_muted = False
+        self.source = None
+        self.volume_sender = LatestValueSender(remote,
+                lambda volume: remote._put_volume(volume, zone),
+                self._on_volume_sent, VOLUME_RATE)
+        self.settings = remote._make_settings(self, zone)
+
+    @property
+    def network_name(self):
+        return self.remote.network_name
+
+    @property
+    def source_param_names(self):
+        return self.remote.source_param_names
+
+    def notify(self, property_name):
+        _notify(self.remote, self, property_name)
+
+    def do_get_property(self, prop):
+        if prop.name == 'volume':
+            return self.volume
+        elif prop.name == 'muted':
+            return self.is_muted
+        elif prop.name == 'power':
+            return self.is_power_on
+        elif prop.name == 'source':
+            return self.source or ""
+        else:
+            raise AttributeError, "Unknown property %s" % prop.name
+
+    def update(self, values):
+        """Apply values from parse_basic_status().  Returns what changed."""
+        changed = []
+        # Don't undo changes that are on their way to the receiver.
+        values = dict(values)
+        if self.volume_sender.is_busy():
+            values.pop("volume", None)
+        for name, setting in self.settings.items():
+            if setting.is_busy():
+                values.pop(name, None)
+        for name in ("power", "source", "volume", "muted"):
+            attr = self.ATTRS[name]
+            if name in values and values[name] != getattr(self, attr):
+                setattr(self, attr, values[name])
+                self.notify(name)
+                changed.append(name)
+        return changed
+
+    def _on_volume_sent(self, volume):
+        if volume != self.volume and self.volume_sender.pending is None:
+            self.volume = volume
+            self.notify('volume')
+
+    def get_is_power_on(self):
+        return self.is_power_on
+
+    def set_is_power_on(self, is_power_on):
+        self.remote.set_is_power_on(is_power_on, self.zone)
+
+    def get_volume(self):
+        return self.volume
+
+    def set_volume(self, volume):
+        self.remote.set_volume(volume, self.zone)
+
+    def get_is_muted(self):
+        return self.is_muted
+
+    def set_is_muted(self, is_muted):
+        self.remote.set_is_muted(is_muted, self.zone)
+
+    def get_source(self):
+        return self.source
+
+    def set_source(self, input_name):
+        self.remote.set_source(input_name, self.zone)
+
+    def get_shuffle_mode(self):
+        return self.remote.get_shuffle_mode()
+
+    def get_repeat_mode(self):
+        return self.remote.get_repeat_mode()
+
 class YamahaRemoteControl(GObject.GObject):
     __gproperties__ = {
         "volume": (float, "volume",
@@ -51,29 +1431,111 @@ class YamahaRemoteControl(GObject.GObject):
                     "Shuffle",
                     "Off",
                     GObject.PARAM_READWRITE),
+        "online": (bool, "online",
+                   "Is the receiver answering",
+                   True,
+                   GObject.PARAM_READABLE),
         }
 
-    def __init__(self):
+    def __init__(self, address=AMP_ADDRESS, share=None, zones=None,
+            transport=None):
         GObject.GObject.__init__(self)
 
+        self.address = address
         self.is_power_on = True
         self.volume = 0.0
-        self.new_volume = 0.0
+        self.volume_sender = LatestValueSender(self, self._put_volume,
+                self._on_volume_sent, VOLUME_RATE, VOLUME_SETTLE,
+                self._on_volume_settled)
         self.is_muted = False
         self.source_param_names = {}
         self.source = None
+        if zones is None:
+            zones = get_receiver_zones(address)
+        self.zones = collections.OrderedDict(
+                (zone, ZoneState(self, zone)) for zone in zones)
         self.shuffle = "Off"
         self.repeat = "Off"
-
-        self.curl = pycurl.Curl()
-        self.curl.setopt(pycurl.POST, 1)
-        url = "http://%s/YamahaRemoteControl/ctrl" % AMP_ADDRESS
-        self.curl.setopt(pycurl.URL, url)
-        self.curl.setopt(pycurl.HTTPHEADER,
-                ['Content-Type: text/xml; charset="utf-8"', 'Expect:'])
+        self.settings = self._make_settings(self)
+        self.play_info = PlayInfo(self)
+        self.settings["shuffle"] = OptimisticSetting(self, self, "shuffle",
+                "shuffle", lambda mode: self._put_play_mode(SHUFFLE_PUT, mode))
+        self.settings["repeat"] = OptimisticSetting(self, self, "repeat",
+                "repeat", lambda mode: self._put_play_mode(REPEAT_PUT, mode))
+
+        self.network_name = None
+        # Request combinations the firmware refused to answer in one GET.
+        self.unbatchable = set()
+        self.response_cache = ResponseCache()
+        self.page_cache = MenuPageCache()
+        # Folder key -> {entry name: line}, least recently used first.
+        self.menu_lines = collections.OrderedDict()
+        # Source -> folder names saved by the last session, for resume_menu().
+        self.resume_paths = {}
+        self.menu_waiter = ReadinessWaiter()
+        self.sync = StateSync(self)
+        # Names of the folders leading to the current menu, per source.
+        self.menu_paths = {}
+
+        self.main_thread = threading.current_thread()
+        self.worker = None
+
+        self.stats = RequestStats()
+        interval = os.environ.get("YAMAHAREMOTE_STATS_INTERVAL")
+        if interval:
+            self.stats.start_logging(float(interval))
+
+        if transport is None:
+            transport = make_transport(address, share,
+                    self._on_online_changed)
+        self.transport = transport
 
     def __del__(self):
-        self.curl.close()
+        self.stop_worker()
+        self.transport.close()
+
+    def start_worker(self):
+        """Run requests submitted with call_async() in a background thread."""
+        if self.worker is None:
+            self.worker = RemoteWorker()
+            self.worker.start()
+
+    def stop_worker(self):
+        if self.worker is not None:
+            self.worker.stop()
+            self.worker = None
+
+    def call_async(self, func, *args, **kwargs):
+        """Call func(*args) on the worker thread.
+
+        The optional callback and error_callback keyword arguments are
+        invoked from the main loop with the result or the exception.  The
+        priority keyword argument is one of PRIORITY_USER (the default),
+        PRIORITY_SYNC or PRIORITY_MENU, and token is an optional
+        CancellationToken.  When no worker is running, the call is made
+        synchronously.
+        """
+        callback = kwargs.get("callback")
+        error_callback = kwargs.get("error_callback")
+        token = kwargs.get("token")
+        if self.worker is not None:
+            self.worker.submit(func, args, callback, error_callback,
+                    kwargs.get("priority", PRIORITY_USER), token)
+            return
+        if token is not None and token.cancelled:
+            return
+        try:
+            result = func(*args)
+        except Exception, e:
+            if error_callback is None:
+                raise
+            error_callback(e)
+            return
+        if callback is not None:
+            callback(result)
+
+    def notify(self, property_name):
+        _notify(self, self, property_name)
 
     def do_get_property(self, prop):
         if prop.name == 'volume':
@@ -86,6 +1548,8 @@ class YamahaRemoteControl(GObject.GObject):
             return self.shuffle
         elif prop.name == 'repeat':
             return self.repeat
+        elif prop.name == 'online':
+            return self.is_online()
         else:
             raise AttributeError, "Unknown property %s" % prop.name
 
@@ -103,20 +1567,59 @@ class YamahaRemoteControl(GObject.GObject):
         else:
             raise AttributeError, "Unknown property %s" % prop.name
 
-    def _exec(self, cmd="GET", data=None):
+    def _exec(self, cmd="GET", data=None, warn=True, accept=None):
+        """Send a request and return the parsed response.
+
+        If accept is given, it is called with the raw response first, and
+        the response is neither parsed nor checked when it returns False;
+        None is returned instead.
+        """
         param = self.source_param_names.get(self.source, "")
-        req = '<?xml version="1.0" encoding="utf-8"?><YAMAHA_AV cmd="%s">%s</YAMAHA_AV>' % (cmd, data.format(param=param))
-        self.curl.setopt(pycurl.POSTFIELDSIZE, len(req))
-        self.curl.setopt(pycurl.READFUNCTION, cStringIO.StringIO(req).read)
-        b = cStringIO.StringIO()
-        self.curl.setopt(pycurl.WRITEFUNCTION, b.write)
-        self.curl.perform()
+        req = build_request(cmd, data, param)
         try:
-            root = ET.fromstring(b.getvalue())
-        except ET.ParseError:
-            print req
+            body = self.transport.perform(cmd, req)
+        except pycurl.error, e:
+            if isinstance(e, ReceiverOfflineError):
+                # Nothing was sent.
+                times = (0, 0, 0)
+            else:
+                times = tuple(self.transport.getinfo(info) for info in
+                        (pycurl.CONNECT_TIME, pycurl.TOTAL_TIME,
+                            pycurl.NUM_CONNECTS))
+            self.stats.record(cmd, data, len(req), 0, times[0], times[1], 0,
+                    "curl %d" % e.args[0], times[2])
             raise
-        error_code = int(root.get("RC"))
+        parse_start = time.time()
+        if accept is not None and not accept(body):
+            root = None
+            match = RC_RE.search(body)
+            error_code = int(match.group(1)) if match else 0
+        else:
+            try:
+                root = ET.fromstring(body)
+            except ET.ParseError:
+                print req
+                raise
+            error_code = int(root.get("RC"))
+        parse_time = time.time() - parse_start
+        self.stats.record(cmd, data, len(req), len(body),
+                self.transport.getinfo(pycurl.CONNECT_TIME),
+                self.transport.getinfo(pycurl.TOTAL_TIME), parse_time,
+                error_code, self.transport.getinfo(pycurl.NUM_CONNECTS))
+        if warn and error_code != 0:
+            self._warn_error(error_code)
+            self.response_cache.invalidate()
+        return root
+
+    def is_online(self):
+        return self.transport.online
+
+    def _on_online_changed(self, online):
+        # The receiver may have been power cycled while unreachable.
+        self.response_cache.invalidate()
+        self.notify('online')
+
+    def _warn_error(self, error_code):
         if error_code == 2:
             print >>sys.stderr, "Warning: error in node designation"
         elif error_code == 3:
@@ -125,138 +1628,645 @@ class YamahaRemoteControl(GObject.GObject):
             print >>sys.stderr, "Warning: not successfully set due to a system error"
         elif error_code == 5:
             print >>sys.stderr, "Warning: internal error"
-        return root
 
     def _get(self, data):
-        return self._exec("GET", data)
+        body = data.format(param=self.source_param_names.get(self.source, ""))
+        root = self.response_cache.get(body)
+        if root is None:
+            root = self._exec("GET", data)
+            self.response_cache.put(body, root)
+        return root
 
     def _put(self, data):
         return self._exec("PUT", data)
 
+    def get_many(self, datas):
+        """Send several GetParam requests in as few round trips as possible.
+
+        Returns one response root per request, in order.  Requests answered
+        by the response cache are not sent.  When the others could be
+        combined, the same root is returned for each of them, so callers
+        must look up their nodes with full paths.  If the firmware rejects
+        the combined body, the requests are sent separately and the
+        combination is not tried again.
+        """
+        param = self.source_param_names.get(self.source, "")
+        bodies = [data.format(param=param) for data in datas]
+        roots = [self.response_cache.get(body) for body in bodies]
+        missing = [i for i, root in enumerate(roots) if root is None]
+
+        key = ("GET",) + tuple(datas[i] for i in missing)
+        if len(missing) > 1 and key not in self.unbatchable:
+            merged = merge_requests([bodies[i] for i in missing])
+            # _exec() formats the body again, so protect any literal braces.
+            root = self._exec("GET",
+                    merged.replace("{", "{{").replace("}", "}}"), warn=False)
+            if root.get("RC") == "0":
+                found = True
+                for i in missing:
+                    for path in request_paths(bodies[i]):
+                        if root.find(path) is None:
+                            found = False
+                if found:
+                    for i in missing:
+                        roots[i] = root
+                        self.response_cache.put(bodies[i], root)
+                    return roots
+            self.unbatchable.add(key)
+
+        for i in missing:
+            roots[i] = self._exec("GET", datas[i])
+            self.response_cache.put(bodies[i], roots[i])
+        return roots
+
+    def put_many(self, datas):
+        """Send several PUT requests in as few round trips as possible.
+
+        Like get_many(), the requests are merged into one body and sent
+        separately if the firmware rejects the combination.  Returns True if
+        the receiver accepted everything.
+        """
+        key = ("PUT",) + tuple(datas)
+        if len(datas) > 1 and key not in self.unbatchable:
+            param = self.source_param_names.get(self.source, "")
+            merged = merge_requests([data.format(param=param) for data in datas])
+            root = self._exec("PUT",
+                    merged.replace("{", "{{").replace("}", "}}"), warn=False)
+            if root.get("RC") == "0":
+                return True
+            self.unbatchable.add(key)
+        accepted = True
+        for data in datas:
+            if self._put(data).get("RC") != "0":
+                accepted = False
+        return accepted
+
+    def apply_settings(self, settings):
+        """Apply several settings as a single transaction.
+
+        settings may contain "power", "source", "volume", "muted", "shuffle"
+        and "repeat", with the same values as the matching setters, and
+        "zones", mapping zones in use to their "power", "source", "volume"
+        and "muted".  Power is turned on first and off last; the input,
+        volume and mute, and all the settings of the other zones, go in one
+        request, then the play modes of the new source in another.
+        Notifications are emitted once everything was sent.  Returns the
+        names of the properties that changed, as sync_status() does.
+
+        Only what the receiver accepted is applied locally; when it refuses
+        part of the input, volume and mute request, the status is read back
+        to find out what it did apply.  Zones not in use are skipped.
+        """
+        changed = []
+        # Changes found by reading the status back, already notified.
+        read_back = []
+        old_source = self.source
+        power = settings.get("power")
+        if power and not self.is_power_on:
+            self.response_cache.invalidate()
+            if self._put(POWER_PUT % "On").get("RC") == "0":
+                self.is_power_on = True
+                changed.append('power')
+
+        main_zone = []
+        source = settings.get("source")
+        if source is not None and source != self.source:
+            main_zone.append(INPUT_SEL_PUT % source)
+        volume = settings.get("volume")
+        if volume is not None:
+            volume = round(volume * 2.0) / 2.0
+            if volume != self.volume:
+                main_zone.append(VOLUME_PUT % round(volume * 10))
+        muted = settings.get("muted")
+        if muted is not None and muted != self.is_muted:
+            main_zone.append(MUTE_PUT % ["Off", "On"][muted])
+        zone_values = []
+        for zone, zone_settings in sorted(settings.get("zones", {}).items()):
+            state = self.zones.get(zone)
+            if state is None:
+                print >>sys.stderr, "Warning: %s is not in use" % zone
+                continue
+            values = dict((name, zone_settings[name]) for name
+                    in ("power", "source", "volume", "muted")
+                    if zone_settings.get(name) is not None)
+            if "volume" in values:
+                values["volume"] = round(values["volume"] * 2.0) / 2.0
+            for name, value in values.items():
+                if value == getattr(state, ZoneState.ATTRS[name]):
+                    del values[name]
+            if "power" in values:
+                main_zone.append(for_zone(POWER_PUT, zone) %
+                        ["Standby", "On"][values["power"]])
+            if "source" in values:
+                main_zone.append(for_zone(INPUT_SEL_PUT, zone) %
+                        values["source"])
+            if "volume" in values:
+                main_zone.append(for_zone(VOLUME_PUT, zone) %
+                        round(values["volume"] * 10))
+            if "muted" in values:
+                main_zone.append(for_zone(MUTE_PUT, zone) %
+                        ["Off", "On"][values["muted"]])
+            zone_values.append((state, values))
+        if self.put_many(main_zone):
+            if source is not None and source != self.source:
+                self.source = source
+                changed.append('source')
+            if volume is not None and volume != self.volume:
+                self.volume = volume
+                changed.append('volume')
+            if muted is not None and muted != self.is_muted:
+                self.is_muted = muted
+                changed.append('muted')
+        else:
+            rsps = self.get_many([BASIC_STATUS_REQ] +
+                    [for_zone(BASIC_STATUS_REQ, zone) for zone in self.zones])
+            read_back += self._update_basic_status(rsps[0])
+            read_back += self._update_zones(rsps[1:])
+            zone_values = []
+
+        shuffle = settings.get("shuffle")
+        repeat = settings.get("repeat")
+        if self.source != old_source:
+            if (self.source not in PLAY_MODE_SOURCES or shuffle is None or
+                    repeat is None):
+                read_back += self.refresh_play_mode()
+            else:
+                # Both modes are about to be set; no need to read them.
+                self.shuffle = self.repeat = None
+        if self.source in PLAY_MODE_SOURCES:
+            play_mode = []
+            if shuffle is not None and shuffle != self.shuffle:
+                play_mode.append(SHUFFLE_PUT % shuffle)
+            if repeat is not None and repeat != self.repeat:
+                play_mode.append(REPEAT_PUT % repeat)
+            if self.put_many(play_mode):
+                if shuffle is not None and shuffle != self.shuffle:
+                    self.shuffle = shuffle
+                    changed.append('shuffle')
+                if repeat is not None and repeat != self.repeat:
+                    self.repeat = repeat
+                    changed.append('repeat')
+            else:
+                read_back += self.refresh_play_mode()
+
+        if power is False and self.is_power_on:
+            self.response_cache.invalidate()
+            if self._put(POWER_PUT % "Standby").get("RC") == "0":
+                self.is_power_on = False
+                changed.append('power')
+
+        for name in changed:
+            self.notify(name)
+        changed += read_back
+        for state, values in zone_values:
+            changed += ["%s/%s" % (state.zone, name)
+                    for name in state.update(values)]
+        return changed
+
+    def get_settings(self):
+        """Return the current settings, in the form apply_settings() takes."""
+        settings = {
+            "power": self.is_power_on,
+            "source": self.source,
+            "volume": self.volume,
+            "muted": self.is_muted,
+        }
+        if self.source in PLAY_MODE_SOURCES:
+            settings["shuffle"] = self.shuffle
+            settings["repeat"] = self.repeat
+        if self.zones:
+            settings["zones"] = dict((zone, {
+                    "power": state.is_power_on,
+                    "source": state.source,
+                    "volume": state.volume,
+                    "muted": state.is_muted,
+                }) for zone, state in self.zones.items())
+        return settings
+
+    def get_scenes(self):
+        return load_config().get("scenes", {})
+
+    def save_scene(self, name, settings=None):
+        """Save settings (by default the current ones) as a named scene."""
+        if settings is None:
+            settings = self.get_settings()
+        config = load_config()
+        config.setdefault("scenes", {})[name] = settings
+        save_config(config)
+
+    def apply_scene(self, name):
+        return self.apply_settings(self.get_scenes()[name])
+
+    def get_snapshot_path(self):
+        name = re.sub(r"[^\w.-]", "_", self.address)
+        return os.path.join(xdg_cache_dir(), "%s.json" % name)
+
+    def save_snapshot(self, menu=None):
+        """Save the last known state so the next start can show it at once.
+
+        menu is an optional (menu name, [(line, text), ...]) pair describing
+        what the menu showed.
+        """
+        snapshot = {
+            "network_name": self.network_name,
+            "source_param_names": self.source_param_names,
+            "power": self.is_power_on,
+            "volume": self.volume,
+            "muted": self.is_muted,
+            "source": self.source,
+            "shuffle": self.shuffle,
+            "repeat": self.repeat,
+            "menu_paths": self.menu_paths,
+        }
+        if menu is not None:
+            name, items = menu
+            snapshot["menu"] = {"name": name,
+                    "items": items[:SNAPSHOT_MENU_ITEMS]}
+        path = self.get_snapshot_path()
+        try:
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path + ".tmp", "w") as f:
+                json.dump(snapshot, f)
+            os.rename(path + ".tmp", path)
+        except (IOError, OSError), e:
+            print >>sys.stderr, "Warning: could not save state: %s" % e
+
+    def load_snapshot(self):
+        """Restore the state saved by save_snapshot() and return it.
+
+        Only the settings are applied; the sources and network name are
+        still fetched by the next refresh(), in the same round trip as the
+        status.  Returns None if there is no usable snapshot.
+        """
+        snapshot = self.read_snapshot()
+        if snapshot is None:
+            return None
+        for name, attr in [("power", "is_power_on"), ("volume", "volume"),
+                ("muted", "is_muted"), ("source", "source"),
+                ("shuffle", "shuffle"), ("repeat", "repeat")]:
+            if name in snapshot and getattr(self, attr) != snapshot[name]:
+                setattr(self, attr, snapshot[name])
+                self.notify(name)
+        self.load_resume_paths(snapshot)
+        return snapshot
+
+    def read_snapshot(self):
+        """Return the state saved by save_snapshot() without applying it."""
+        try:
+            with open(self.get_snapshot_path()) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return None
+
+    def load_resume_paths(self, snapshot):
+        self.resume_paths = dict((source, path[1:]) for source, path
+                in snapshot.get("menu_paths", {}).items())
+
     def get_network_name(self):
-        cmd = "<System><Misc><Network><Network_Name>GetParam</Network_Name></Network></Misc></System>"
-        return self._get(cmd).find("System/Misc/Network/Network_Name").text
+        self._update_network_name(self._get(NETWORK_NAME_REQ))
+        return self.network_name
+
+    def _update_network_name(self, root):
+        self.network_name = root.find("System/Misc/Network/Network_Name").text
+
+    def get_zone(self, zone):
+        """Return the ZoneState of zone, or the remote itself for Main_Zone.
+
+        Raises KeyError for zones not in use.
+        """
+        if zone is None or zone == "Main_Zone":
+            return self
+        return self.zones[zone]
+
+    def _make_settings(self, state, zone=None):
+        """Return the OptimisticSettings of the power, mute and input."""
+        def put_power(is_power_on):
+            self._put_setting(for_zone(POWER_PUT, zone) %
+                    ["Standby", "On"][is_power_on])
+            self.response_cache.invalidate()
+
+        def put_muted(is_muted):
+            self._put_setting(for_zone(MUTE_PUT, zone) %
+                    ["Off", "On"][is_muted])
+
+        def put_source(input_name):
+            self._put_setting(for_zone(INPUT_SEL_PUT, zone) % input_name)
+            if state is self:
+                self.refresh_play_mode()
+                self.play_info.reset()
+                if self.play_info.is_polled():
+                    self.refresh_play_info()
+
+        return {
+            "power": OptimisticSetting(self, state, "power", "is_power_on",
+                put_power),
+            "muted": OptimisticSetting(self, state, "muted", "is_muted",
+                put_muted),
+            "source": OptimisticSetting(self, state, "source", "source",
+                put_source),
+        }
 
-    def set_is_power_on(self, is_power_on):
-        if is_power_on != self.is_power_on:
-            cmd = "<Main_Zone><Power_Control><Power>%s</Power></Power_Control></Main_Zone>" % ["Standby", "On"][is_power_on]
-            self._put(cmd)
-            self.is_power_on = is_power_on
-            self.notify('power')
+    def _put_setting(self, data):
+        root = self._put(data)
+        error_code = int(root.get("RC"))
+        if error_code != 0:
+            raise RequestRefusedError(data, error_code)
+
+    def set_is_power_on(self, is_power_on, zone=None):
+        """Turn the power on or off.
+
+        Like the other setters, this shows the new state right away and
+        sends it in the background; see OptimisticSetting.
+        """
+        self.get_zone(zone).settings["power"].set(is_power_on)
 
     def get_is_power_on(self):
         return self.is_power_on
 
-    def set_volume(self, volume):
+    def set_volume(self, volume, zone=None):
+        state = self.get_zone(zone)
         volume = round(volume * 2.0) / 2.0
-        if volume != self.volume:
-            self.new_volume = volume
-            GObject.idle_add(self._set_volume)
+        if volume != state.volume or state.volume_sender.is_busy():
+            state.volume_sender.set(volume)
 
-    def _set_volume(self):
-        if self.volume == self.new_volume:
+    def _put_volume(self, volume, zone=None):
+        self._put(for_zone(VOLUME_PUT, zone) % round(volume * 10))
+
+    def _on_volume_sent(self, volume):
+        # Don't move the slider back while newer values are on their way.
+        if volume != self.volume and self.volume_sender.pending is None:
+            self.volume = volume
+            self.notify('volume')
+
+    def _on_volume_settled(self):
+        self.call_async(self.refresh_volume, priority=PRIORITY_SYNC)
+
+    def refresh_volume(self):
+        """Read back the volume level the receiver actually applied."""
+        req = "<Main_Zone><Volume><Lvl>GetParam</Lvl></Volume></Main_Zone>"
+        self._update_volume(self._get(req).find("Main_Zone/Volume/Lvl"))
+
+    def _update_volume(self, level):
+        if self.volume_sender.is_busy():
             return False
-        volume = self.new_volume
-        req = "<Main_Zone><Volume><Lvl><Val>%d</Val><Exp>1</Exp><Unit>dB</Unit></Lvl></Volume></Main_Zone>" % round(volume * 10)
-        self._put(req)
+        val = int(level.find("Val").text)
+        exp = int(level.find("Exp").text)
+        volume = val / 10.0**exp
         if volume != self.volume:
             self.volume = volume
             self.notify('volume')
+            return True
         return False
 
     def get_volume(self):
         return self.volume
 
-    def set_is_muted(self, is_muted):
-        if is_muted != self.is_muted:
-            req = "<Main_Zone><Volume><Mute>%s</Mute></Volume></Main_Zone>" % ["Off", "On"][is_muted]
-            self._put(req)
-            self.is_muted = is_muted
-            self.notify('muted')
+    def set_is_muted(self, is_muted, zone=None):
+        self.get_zone(zone).settings["muted"].set(is_muted)
 
     def get_is_muted(self):
         return self.is_muted
 
     def refresh(self):
-        req = "<Main_Zone><Basic_Status>GetParam</Basic_Status></Main_Zone>"
-        status = self._get(req)[0].find('Basic_Status')
-
-        val = int(status.find("Volume/Lvl/Val").text)
-        exp = int(status.find("Volume/Lvl/Exp").text)
-        volume = val / 10.0**exp
-        if volume != self.volume:
-            self.volume = volume
-            self.notify('volume')
+        """Update the state from the receiver.
+
+        The sources and network name come from the response cache when they
+        are still fresh, and otherwise in the same round trip as the status.
+        """
+        zone_reqs = [for_zone(BASIC_STATUS_REQ, zone) for zone in self.zones]
+        rsps = self.get_many(
+                [BASIC_STATUS_REQ, INPUT_SEL_ITEM_REQ, NETWORK_NAME_REQ] +
+                zone_reqs)
+        status, sources, network_name = rsps[:3]
+        self._update_sources(sources)
+        self._update_network_name(network_name)
+        self._update_basic_status(status)
+        self._update_zones(rsps[3:])
 
+        self.refresh_play_mode()
+        if self.play_info.is_polled():
+            self.refresh_play_info()
+
+    def sync_status(self):
+        """Poll Basic_Status only.  Returns the names of changed properties.
+
+        The status of every zone in use comes in the same request, and
+        their changes are named like "Zone_2/volume".  Play modes are only
+        queried again when the source of Main_Zone changed.
+        """
+        source = self.source
+        play_reqs = []
+        if self.play_info.is_polled():
+            play_reqs = self._play_info_requests()
+        rsps = self.get_many([BASIC_STATUS_REQ] +
+                [for_zone(BASIC_STATUS_REQ, zone) for zone in self.zones] +
+                play_reqs)
+        changed = self._update_basic_status(rsps[0])
+        if "source" in changed:
+            self.refresh_play_mode()
+        changed += self._update_zones(rsps[1:len(rsps) - len(play_reqs)])
+        if play_reqs and self.source == source:
+            changed += self._update_play_info(rsps[-1])
+        else:
+            # Nothing is shown, or Play_Info came from the previous input.
+            self.play_info.reset()
+            if self.play_info.is_polled():
+                changed += self.refresh_play_info()
+        return changed
+
+    def _play_info_requests(self):
+        if self.source in PLAY_TIME_SOURCES:
+            return [PLAYBACK_INFO_REQ, PLAY_TIME_REQ]
+        return [PLAYBACK_INFO_REQ, META_INFO_REQ]
+
+    def refresh_play_info(self):
+        """Poll Play_Info.  Returns the names of changed properties.
+
+        See PlayInfo; sync_status() does this in the same request as the
+        status while Play_Info is watched.
+        """
+        if self.source not in PLAY_INFO_SOURCES:
+            self.play_info.reset()
+            return []
+        return self._update_play_info(
+                self.get_many(self._play_info_requests())[-1])
+
+    def _update_play_info(self, root):
+        info = root.find("*/Play_Info")
+        play_time = info.find("Play_Time/Elapsed")
+        elapsed = None
+        if play_time is not None:
+            elapsed = (int(play_time.findtext("Hour") or 0) * 3600 +
+                    int(play_time.findtext("Min") or 0) * 60 +
+                    int(play_time.findtext("Sec") or 0))
+        playback = info.findtext("Playback_Info")
+        before = self.play_info.playback
+        track_changed = self.play_info.update(playback, elapsed)
+        changed = []
+        if playback != before:
+            changed.append("playback")
+        if playback == "Stop":
+            return ["play_info/%s" % name for name in changed]
+
+        meta = info.find("Meta_Info")
+        if meta is None:
+            if track_changed:
+                meta, art = self.get_many([META_INFO_REQ, ALBUM_ART_REQ])
+                changed += self.play_info.update_meta(
+                        meta.find("*/Play_Info/Meta_Info"))
+                self._update_album_art(art.find("*/Play_Info/Album_ART"))
+        else:
+            # The metadata was polled, as there is no elapsed time.
+            meta_changed = self.play_info.update_meta(meta)
+            if meta_changed or track_changed:
+                art = self.get_many([ALBUM_ART_REQ])[0]
+                self._update_album_art(art.find("*/Play_Info/Album_ART"))
+            changed += meta_changed
+        self.play_info.fetch_pending = False
+        return ["play_info/%s" % name for name in changed]
+
+    def _update_album_art(self, node):
+        play_info = self.play_info
+        url = node.findtext("URL") if node is not None else None
+        if not url:
+            play_info.set_art(None, None)
+            return
+        # Receivers serve every cover at the same URL, told apart by ID.
+        key = (url, node.findtext("ID"))
+        if key == play_info.art_key:
+            return
+        art = play_info.get_art(key)
+        if art is None:
+            try:
+                art = self.transport.fetch(url)
+            except pycurl.error:
+                # Do not leave the previous cover shown; the next poll
+                # tries again.
+                play_info.set_art(None, None)
+                raise
+            if art is not None:
+                play_info.put_art(key, art)
+        play_info.set_art(key, art)
+
+    def _update_zones(self, roots):
+        changed = []
+        for state, root in zip(self.zones.values(), roots):
+            values = parse_basic_status(
+                    root.find("%s/Basic_Status" % state.zone))
+            changed += ["%s/%s" % (state.zone, name)
+                    for name in state.update(values)]
+        return changed
+
+    def _update_basic_status(self, root):
+        status = root.find("Main_Zone/Basic_Status")
+        changed = []
+
+        if self._update_volume(status.find("Volume/Lvl")):
+            changed.append('volume')
+
+        # Don't undo changes that are on their way to the receiver.
+        settings = self.settings
         is_muted = status.find("Volume/Mute").text == "On"
-        if is_muted != self.is_muted:
+        if is_muted != self.is_muted and not settings["muted"].is_busy():
             self.is_muted = is_muted
             self.notify('muted')
+            changed.append('muted')
 
         is_power_on = status.find("Power_Control/Power").text == "On"
-        if is_power_on != self.is_power_on:
+        if is_power_on != self.is_power_on and not settings["power"].is_busy():
+            self.response_cache.invalidate()
             self.is_power_on = is_power_on
             self.notify('power')
+            changed.append('power')
 
         source = status.find("Input/Input_Sel").text
-        if source != self.source:
+        if source != self.source and not settings["source"].is_busy():
             self.source = source
             self.notify('source')
+            changed.append('source')
 
-        if not self.source_param_names:
-            self.get_sources()
-
-        self.refresh_play_mode()
+        return changed
 
     def get_sources(self):
-        cmd = "<Main_Zone><Input><Input_Sel_Item>GetParam</Input_Sel_Item></Input></Main_Zone>"
-        items = self._get(cmd).find("Main_Zone/Input/Input_Sel_Item")
-        self.source_param_names = {}
+        self._update_sources(self._get(INPUT_SEL_ITEM_REQ))
+        return sorted(self.source_param_names.keys())
+
+    def _update_sources(self, root):
+        items = root.find("Main_Zone/Input/Input_Sel_Item")
+        source_param_names = {}
         for item in items.getchildren():
             if item.find("RW").text == "R":
                 continue
-            self.source_param_names[item.find("Param").text] = item.find("Src_Name").text
-        return sorted(self.source_param_names.keys())
+            source_param_names[item.find("Param").text] = item.find("Src_Name").text
+        self.source_param_names = source_param_names
 
     def get_source(self):
         return self.source
 
-    def set_source(self, input_name):
-        if input_name != self.source:
-            cmd = "<Main_Zone><Input><Input_Sel>%s</Input_Sel></Input></Main_Zone>" % input_name
-            self._put(cmd)
-            self.source = input_name
-            self.notify('source')
-            self.refresh_play_mode()
+    def set_source(self, input_name, zone=None, callback=None):
+        """Select an input.  callback is called once the receiver did."""
+        self.get_zone(zone).settings["source"].set(input_name, callback)
 
     def refresh_play_mode(self):
+        """Read the play modes.  Returns the names of changed properties."""
         if self.source is None:
-            return
-
-        if self.source in ["USB", "iPod_USB", "SERVER"]:
-            cmd = "<{param}><Play_Control><Play_Mode><Shuffle>GetParam</Shuffle></Play_Mode></Play_Control></{param}>"
-            shuffle = self._get(cmd)
-            self.set_shuffle_mode(shuffle.find("*/Play_Control/Play_Mode/Shuffle").text)
+            return []
 
-            cmd = "<{param}><Play_Control><Play_Mode><Repeat>GetParam</Repeat></Play_Mode></Play_Control></{param}>"
-            repeat = self._get(cmd)
-            self.set_repeat_mode(repeat.find("*/Play_Control/Play_Mode/Repeat").text)
+        if self.source in PLAY_MODE_SOURCES:
+            shuffle, repeat = self.get_many([SHUFFLE_REQ, REPEAT_REQ])
+            return self._update_play_mode(
+                    shuffle.find("*/Play_Control/Play_Mode/Shuffle").text,
+                    repeat.find("*/Play_Control/Play_Mode/Repeat").text)
         else:
-            self.set_shuffle_mode(None)
-            self.set_repeat_mode(None)
+            return self._update_play_mode(None, None)
 
-    def wait_for_menu_info(self):
+    def _update_play_mode(self, shuffle, repeat):
+        # The receiver already has these values, so there is nothing to PUT.
+        changed = []
+        if shuffle != self.shuffle and not self.settings["shuffle"].is_busy():
+            self.shuffle = shuffle
+            self.notify('shuffle')
+            changed.append('shuffle')
+        if repeat != self.repeat and not self.settings["repeat"].is_busy():
+            self.repeat = repeat
+            self.notify('repeat')
+            changed.append('repeat')
+        return changed
+
+    def wait_for_menu_info(self, deadline=None):
+        """Return the List_Info node once the menu is ready.
+
+        Raises MenuTimeoutError if the menu is still busy after the deadline
+        (MENU_DEADLINE seconds by default).
+        """
         if self.source is None:
             return None
-        for i in range(20):
-            cmd = "<{param}><List_Info>GetParam</List_Info></{param}>"
-            rsp = self._get(cmd)
 
-            info = rsp.find("*/List_Info")
-            status = info.find("Menu_Status").text
-            if status == "Ready":
+        def poll():
+            root = self._exec("GET", LIST_INFO_REQ, accept=is_menu_ready)
+            if root is None:
+                return None
+            info = root[0].find("List_Info")
+            if info.findtext("Menu_Status") == "Ready":
                 return info
-            time.sleep(0.05)
+            return None
+
+        info = self.menu_waiter.wait(self.source, poll, deadline)
+        self._update_menu_path(info)
+        return info
+
+    def _update_menu_path(self, info):
+        layer = int(info.find("Menu_Layer").text)
+        path = self.menu_paths.get(self.source, [])[:layer - 1]
+        # Folders we never saw on the way down stay unknown.
+        path += [None] * (layer - 1 - len(path))
+        path.append(info.find("Menu_Name").text)
+        self.menu_paths[self.source] = path
+
+    def get_menu_folder(self):
+        """Return a key identifying the current menu folder."""
+        return (self.source,) + tuple(self.menu_paths.get(self.source, []))
 
     def jump_to_line(self, line):
         cmd = "<{param}><List_Control><Jump_Line>%d</Jump_Line></List_Control></{param}>" % line
@@ -271,30 +2281,258 @@ class YamahaRemoteControl(GObject.GObject):
         else:
             return ""
 
-    def get_menu(self):
-        info = self.wait_for_menu_info()
-        if info is None:
-            return
-        max_line = int(info.find("Cursor_Position/Max_Line").text)
+    def get_menu_pages(self):
+        """Yield the current menu one page of (line, text) items at a time.
+
+        Pages already seen in this folder are served from the page cache.
+        """
+        for entries in self.get_menu_entry_pages():
+            yield [(line, text) for line, text, attribute in entries]
 
+    def get_menu_entry_pages(self):
+        """Like get_menu_pages(), with (line, text, attribute) entries.
+
+        The attribute is "Container" for folders and "Item" for playable
+        entries.
+        """
+        folder, max_line = self.get_menu_size()
         line = 1
         while line <= max_line:
+            page = self.get_menu_page(folder, max_line, line)
+            if page is None:
+                return
+            yield page
+            line += 8
+
+    def get_menu_size(self):
+        """Return the current menu folder key and its number of lines."""
+        info = self.wait_for_menu_info()
+        if info is None:
+            return None, 0
+        return (self.get_menu_folder(),
+                int(info.find("Cursor_Position/Max_Line").text))
+
+    def get_menu_page(self, folder, max_line, line):
+        """Return the (line, text, attribute) entries of one page.
+
+        folder and max_line come from get_menu_size() and line is the first
+        line of the page.  Returns None if the receiver is no longer in that
+        folder.
+        """
+        items = self.page_cache.get((folder, line), max_line)
+        if items is None:
             self.jump_to_line(line)
             info = self.wait_for_menu_info()
-            for e in info.find("Current_List").getchildren():
-                if e.find("Attribute").text != "Unselectable":
-                    text = e.find("Txt").text
-                    # Sometimes, entities are double-encoded.
-                    text = text.replace("&amp;", "&")
-                    yield (line + int(e.tag[5:]) - 1, text)
-            line += 8
+            if self.get_menu_folder() != folder:
+                return None
+            items = self._parse_menu_page(info, line)
+            self.page_cache.put((folder, line), max_line, items)
+        self._remember_lines(folder, items)
+        return items
+
+    def _remember_lines(self, folder, items):
+        lines = self.menu_lines.pop(folder, None)
+        if lines is None:
+            lines = {}
+        for line, text, attribute in items:
+            lines[text] = line
+        self.menu_lines[folder] = lines
+        while len(self.menu_lines) > MENU_LINE_FOLDERS:
+            self.menu_lines.popitem(last=False)
+
+    def _parse_menu_page(self, info, line):
+        items = []
+        for e in info.find("Current_List"):
+            attribute = e.findtext("Attribute")
+            if attribute != "Unselectable":
+                # Sometimes, entities are double-encoded.
+                text = e.findtext("Txt").replace("&amp;", "&")
+                items.append((line + int(e.tag[5:]) - 1, text, attribute))
+        return items
+
+    def get_menu(self):
+        for items in self.get_menu_pages():
+            for item in items:
+                yield item
 
     def select_menu(self, line):
         self.jump_to_line(line)
         info = self.wait_for_menu_info()
+        self._direct_select(line)
+
+    def _direct_select(self, line):
         cmd = "<{param}><List_Control><Direct_Sel>Line_%d</Direct_Sel></List_Control></{param}>" % ((line - 1) % 8 + 1)
         self._put(cmd)
 
+    def menu_root(self):
+        """Go back to the top menu of the current source."""
+        info = self.wait_for_menu_info()
+        while int(info.find("Menu_Layer").text) > 1:
+            self.menu_return()
+            info = self.wait_for_menu_info()
+        return info
+
+    def select_path(self, path, names=None):
+        """Select the entry at path, a sequence of line numbers from the top.
+
+        Each level costs a Direct_Sel, plus a Jump_Line only when the line
+        is not on the page shown when entering the folder.  names are the
+        expected names of the entries along path, if known: each line is
+        then checked against the displayed page, and the folder is listed
+        again when the entry has moved.  Raises KeyError when it is gone.
+        """
+        info = self.menu_root()
+        for i, line in enumerate(path):
+            if names is None:
+                info = self._show_line(info, line)
+            else:
+                live = self._check_menu_line(info, line, names[i])
+                if live is None:
+                    self._forget_menu_folder(self.get_menu_folder())
+                    line, live = self._find_menu_line(info, names[i])
+                info = live
+            self._direct_select(line)
+            info = self.wait_for_menu_info()
+
+    def navigate(self, path):
+        """Select the entry at path from the top menu of the current source.
+
+        path items are line numbers or entry names.  Names are looked up in
+        the lines remembered from earlier listings of the same folder, and
+        the folder pages are only scanned when the name is not known or has
+        moved.  Folders already open along the path are not left.  Raises
+        KeyError when a name is not found.  Returns the List_Info shown
+        after the last selection.
+        """
+        path = list(path)
+        info = self.wait_for_menu_info()
+        opened = self.menu_paths.get(self.source, [])[1:]
+        depth = 0
+        while depth < min(len(opened), len(path)) and \
+                opened[depth] == path[depth]:
+            depth += 1
+        for i in range(len(opened) - depth):
+            self.menu_return()
+            info = self.wait_for_menu_info()
+
+        for entry in path[depth:]:
+            if isinstance(entry, basestring):
+                line, info = self._find_menu_line(info, entry)
+            else:
+                line = entry
+                info = self._show_line(info, line)
+            self._direct_select(line)
+            info = self.wait_for_menu_info()
+        return info
+
+    def _show_line(self, info, line):
+        """Make sure the page holding line is displayed."""
+        current = int(info.find("Cursor_Position/Current_Line").text)
+        if (line - 1) // 8 != (current - 1) // 8:
+            self.jump_to_line(line)
+            info = self.wait_for_menu_info()
+        return info
+
+    def _find_menu_line(self, info, name):
+        """Return the line of the entry called name, and the page showing it."""
+        folder = self.get_menu_folder()
+        line = self.menu_lines.get(folder, {}).get(name)
+        if line is not None:
+            live = self._check_menu_line(info, line, name)
+            if live is not None:
+                return line, live
+            # The folder changed since it was listed.
+            self._forget_menu_folder(folder)
+
+        # Cached pages may be stale too, so a line found in them is checked
+        # against the displayed page, and the folder is read again if the
+        # check fails.
+        for attempt in range(2):
+            stale = False
+            for page in self.get_menu_entry_pages():
+                for line, text, attribute in page:
+                    if text == name:
+                        live = self._check_menu_line(
+                                self.wait_for_menu_info(), line, name)
+                        if live is not None:
+                            return line, live
+                        stale = True
+                        break
+                if stale:
+                    break
+            if not stale:
+                break
+            self._forget_menu_folder(folder)
+        raise KeyError(name)
+
+    def _check_menu_line(self, info, line, name):
+        """Show the page holding line and return it if name is on that line.
+
+        Returns None when the receiver shows something else there.
+        """
+        info = self._show_line(info, line)
+        first = (line - 1) // 8 * 8 + 1
+        entries = self._parse_menu_page(info, first)
+        if (line, name) in [(l, text) for l, text, a in entries]:
+            return info
+        return None
+
+    def _forget_menu_folder(self, folder):
+        self.menu_lines.pop(folder, None)
+        self.page_cache.discard_folder(folder)
+
+    def get_menu_location(self):
+        """Return the names of the folders open below the top menu."""
+        return list(self.menu_paths.get(self.source, [])[1:])
+
+    def resume_menu(self):
+        """Reopen the folder the previous session was browsing, if known.
+
+        This is only done once per source.
+        """
+        path = self.resume_paths.pop(self.source, None)
+        if not path or None in path:
+            return None
+        return self.navigate(path)
+
+    def get_favorites(self):
+        return load_config().get("favorites", {})
+
+    def find_menu_location(self):
+        """Like get_menu_location(), finding out unknown folder names.
+
+        Folders opened before this process started have no known name.
+        The menu is then walked up to the first known folder, and back down
+        by the names of the folders it went through.
+        """
+        info = self.wait_for_menu_info()
+        names = []
+        while None in self.menu_paths.get(self.source, []):
+            names.append(self.menu_paths[self.source][-1])
+            self.menu_return()
+            info = self.wait_for_menu_info()
+        for name in reversed(names):
+            line, info = self._find_menu_line(info, name)
+            self._direct_select(line)
+            info = self.wait_for_menu_info()
+        return self.get_menu_location()
+
+    def save_favorite(self, name, path=None):
+        """Save path (by default the open folder) as a named favorite."""
+        if path is None:
+            path = self.find_menu_location()
+        if None in path:
+            raise ValueError("the open folder has an unknown parent")
+        config = load_config()
+        config.setdefault("favorites", {})[name] = {
+                "source": self.source, "path": path}
+        save_config(config)
+
+    def open_favorite(self, name):
+        favorite = self.get_favorites()[name]
+        self.set_source(favorite["source"])
+        return self.navigate(favorite["path"])
+
     def menu_return(self):
         if self.source is None:
             return
@@ -308,23 +2546,80 @@ class YamahaRemoteControl(GObject.GObject):
         return self.shuffle
 
     def set_shuffle_mode(self, shuffle_mode):
-        if self.shuffle != shuffle_mode:
-            if shuffle_mode is not None:
-                cmd = "<{param}><Play_Control><Play_Mode><Shuffle>%s</Shuffle></Play_Mode></Play_Control></{param}>"
-                self._put(cmd % shuffle_mode)
-            self.shuffle = shuffle_mode
-            self.notify('shuffle')
+        self.settings["shuffle"].set(shuffle_mode)
+
+    def _put_play_mode(self, data, mode):
+        # None means the source has no play modes.
+        if mode is not None:
+            self._put_setting(data % mode)
 
     def get_repeat_mode(self):
         return self.repeat
 
     def set_repeat_mode(self, repeat_mode):
-        if self.repeat != repeat_mode:
-            if repeat_mode is not None:
-                cmd = "<{param}><Play_Control><Play_Mode><Repeat>%s</Repeat></Play_Mode></Play_Control></{param}>"
-                self._put(cmd % repeat_mode)
-            self.repeat = repeat_mode
-            self.notify('repeat')
+        self.settings["repeat"].set(repeat_mode)
+
+class ReceiverGroup(object):
+    """One YamahaRemoteControl per configured receiver.
+
+    The remotes are created once and share a CurlShare, so switching from
+    one receiver to another does not reopen connections.  Operations on
+    several receivers run concurrently and take as long as the slowest.
+    """
+
+    def __init__(self, addresses=None):
+        if addresses is None:
+            addresses = get_receiver_addresses()
+        self.share = make_curl_share()
+        self.remotes = collections.OrderedDict()
+        for address in addresses:
+            self.add(address)
+
+    def add(self, address):
+        if address not in self.remotes:
+            self.remotes[address] = YamahaRemoteControl(address, self.share)
+        return self.remotes[address]
+
+    def find(self, name):
+        """Return the remote with this address or network name."""
+        for remote in self.remotes.values():
+            if name in (remote.address, remote.network_name):
+                return remote
+        raise KeyError(name)
+
+    def run_all(self, func, remotes=None):
+        """Call func(remote) for each remote, in parallel, and wait.
+
+        Returns a list of (remote, result, exception) in the order of the
+        remotes.  This uses the remotes from the calling thread, so it is
+        not meant for remotes whose worker is running.
+        """
+        if remotes is None:
+            remotes = self.remotes.values()
+        results = [None] * len(remotes)
+
+        def run(i, remote):
+            try:
+                results[i] = (remote, func(remote), None)
+            except Exception, e:
+                results[i] = (remote, None, e)
+
+        threads = []
+        for i, remote in enumerate(remotes):
+            if i == len(remotes) - 1:
+                run(i, remote)
+                break
+            thread = threading.Thread(target=run, args=(i, remote))
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+        return results
+
+    def stop(self):
+        for remote in self.remotes.values():
+            remote.stop_worker()
 
 nice_names = {
         'SERVER': 'Media Server',
@@ -334,316 +2629,387 @@ nice_names = {
         'V-AUX': 'Auxiliary Input',
 }
 
-class YamahaRemoteWindow(Gtk.Window):
-    def __init__(self):
-        Gtk.Window.__init__(self, title="Yamaha Remote Control")
-        self.set_size_request(500, -1)
-        self.set_resizable(False)
-        self.set_border_width(12)
-
-        self.load_id = None
-
-        vbox = Gtk.Box(orientation=Gtk.Orientation.VERTICAL, spacing=18)
-        self.add(vbox)
-
-        system_box = Gtk.Box(spacing=12)
-        vbox.pack_start(system_box, False, False, 0)
-
-        image = Gtk.Image.new_from_icon_name("audio-speakers", Gtk.IconSize.DIALOG)
-        system_box.pack_start(image, False, False, 0)
-
-        name_label = Gtk.Label()
-        name_label.set_markup("<b>Receiver</b>")
-        system_box.pack_start(name_label, False, False, 0)
-
-        power_box = Gtk.Alignment(xalign=1.0, yalign=0.5, xscale=0.0, yscale=0.0)
-        self.power_switch = Gtk.Switch()
-        self.power_switch.set_active(True)
-        self.power_switch.connect('notify::active', self.on_power_notify)
-        power_box.add(self.power_switch)
-        system_box.pack_start(power_box, True, True, 0)
-
-        volume_box = Gtk.Box(spacing=12)
-        alignment = Gtk.Alignment(xalign=0, yalign=0, xscale=1, yscale=1)
-        alignment.add(volume_box)
-        vbox.pack_start(alignment, False, False, 0)
-
-        label = Gtk.Label()
-        label.set_label("Volume:")
-        label.set_alignment(0.0, 0.5)
-        volume_box.pack_start(label, False, False, 0)
-
-        adj = Gtk.Adjustment(-40.0, -80.0, 16.0, 0.5, 5.0, 0.0)
-        self.volume_bar = Gtk.Scale(orientation=Gtk.Orientation.HORIZONTAL,
-                adjustment=adj)
-        self.volume_bar.set_size_request(128, -1)
-        self.volume_bar.set_draw_value(False)
-        self.volume_bar.add_mark(0.0, Gtk.PositionType.BOTTOM,
-                "<small>100%</small>")
-        adj.connect('value-changed', self.on_volume_changed)
-        volume_box.pack_start(self.volume_bar, True, True, 0)
-
-        mute_box = Gtk.Alignment(xalign=0.5, yalign=0.0, xscale=0.0, yscale=0.0)
-        self.mute_switch = Gtk.Switch()
-        self.mute_switch.set_active(True)
-        self.mute_switch.connect('notify::active', self.on_is_muted_notify)
-        mute_box.add(self.mute_switch)
-        volume_box.pack_start(mute_box, False, False, 0)
-
-        input_box = Gtk.Box(spacing=12)
-        vbox.pack_start(input_box, True, True, 0)
-
-        label = Gtk.Label("Source:")
-        input_box.pack_start(label, False, False, 0)
-
-        store = Gtk.ListStore(str, str)
-        self.source_combo = Gtk.ComboBox.new_with_model(store)
-        self.source_combo.connect("changed", self.on_input_selection_changed)
-        input_box.pack_start(self.source_combo, True, True, 0)
-        renderer = Gtk.CellRendererText()
-        self.source_combo.pack_start(renderer, True)
-        self.source_combo.add_attribute(renderer, "text", 0)
-
-        self.menu_box = Gtk.Box(orientation=Gtk.Orientation.VERTICAL, spacing=12)
-        self.menu_box.set_no_show_all(True)
-        vbox.pack_start(self.menu_box, False, False, 0)
-
-        box = Gtk.Box(spacing=12)
-        box.show()
-        self.menu_box.pack_start(box, True, True, 0)
-
-        alignment = Gtk.Alignment(xalign=0.0)
-        alignment.show()
-        box.pack_start(alignment, True, True, 0)
-        path_bar = Gtk.Box()
-        path_bar.get_style_context().add_class("linked")
-        path_bar.show()
-        alignment.add(path_bar)
-
-        self.parent_button = Gtk.Button()
-        self.parent_button.set_focus_on_click(False)
-        self.parent_button.show()
-        arrow = Gtk.Arrow(Gtk.ArrowType.LEFT, Gtk.ShadowType.OUT)
-        arrow.show()
-        self.parent_button.add(arrow)
-        self.parent_button.connect("clicked", self.on_parent_button_clicked)
-        path_bar.add(self.parent_button)
-
-        self.current_button = Gtk.ToggleButton("Current")
-        self.current_button.set_focus_on_click(False)
-        self.current_button.set_active(True)
-        self.current_button.connect("clicked", self.on_current_button_clicked)
-        self.current_button.show()
-        path_bar.add(self.current_button)
-
-        alignment = Gtk.Alignment(xalign=1.0, xscale=1.0)
-        alignment.show()
-        box.pack_start(alignment, False, False, 0)
-        button_box = Gtk.Box(spacing=6)
-        button_box.show()
-        alignment.add(button_box)
-        self.repeat_button = Gtk.ToggleButton("Repeat")
-        self.repeat_button.connect("clicked", self.on_repeat_button_clicked)
-        self.repeat_button.show()
-        button_box.pack_start(self.repeat_button, False, False, 0)
-        self.shuffle_button = Gtk.ToggleButton("Shuffle")
-        self.shuffle_button.connect("clicked", self.on_shuffle_button_clicked)
-        self.shuffle_button.show()
-        button_box.pack_start(self.shuffle_button, False, False, 0)
-
-        scrolled = Gtk.ScrolledWindow()
-        scrolled.set_policy(Gtk.PolicyType.NEVER, Gtk.PolicyType.AUTOMATIC)
-        scrolled.set_shadow_type(Gtk.ShadowType.IN)
-        scrolled.set_min_content_height(250)
-        scrolled.show()
-        self.menu_box.pack_start(scrolled, True, True, 0)
-
-        self.menu_tree = Gtk.TreeView()
-        self.menu_tree.set_rules_hint(True)
-        self.menu_tree.set_headers_visible(False)
-        self.menu_tree.connect("row-activated", self.on_menu_row_activated)
-        self.menu_tree.show()
-        scrolled.add(self.menu_tree)
-
-        renderer = Gtk.CellRendererText()
-        renderer.set_property("ellipsize", Pango.EllipsizeMode.END);
-        column = Gtk.TreeViewColumn("Text", renderer, text=0)
-        column.set_cell_data_func(renderer, self.cell_data_func)
-        self.menu_tree.append_column(column)
-
-        self.remote = YamahaRemoteControl()
-        self.remote.connect("notify::volume", self.on_remote_volume_notify)
-        self.remote.connect("notify::muted", self.on_remote_muted_notify)
-        self.remote.connect("notify::power", self.on_remote_power_notify)
-        self.remote.connect("notify::repeat", self.on_remote_repeat_notify)
-        self.remote.connect("notify::shuffle", self.on_remote_shuffle_notify)
-        self.remote.refresh()
-
-        name_label.set_markup("<b>%s</b>" % self.remote.get_network_name())
-        input_iter = self.add_inputs()
-        if input_iter is not None:
-            self.source_combo.handler_block_by_func(self.on_input_selection_changed)
-            self.source_combo.set_active_iter(input_iter)
-            self.source_combo.handler_unblock_by_func(self.on_input_selection_changed)
-
-        self.update_menu()
-
-    def on_power_notify(self, switch, data):
-        self.remote.set_is_power_on(switch.get_active())
-
-    def on_remote_power_notify(self, remote, data):
-        self.power_switch.freeze_notify()
-        self.power_switch.set_active(self.remote.get_is_power_on())
-        self.power_switch.thaw_notify()
-
-    def on_volume_changed(self, adjustment):
-        volume = adjustment.get_value()
-        self.remote.set_volume(volume)
-
-    def on_remote_volume_notify(self, remote, data):
-        adj = self.volume_bar.get_adjustment()
-        adj.handler_block_by_func(self.on_volume_changed)
-        adj.set_value(self.remote.get_volume())
-        adj.handler_unblock_by_func(self.on_volume_changed)
-
-    def on_is_muted_notify(self, switch, active):
-        self.remote.set_is_muted(not switch.get_active())
-
-    def on_remote_muted_notify(self, remote, data):
-        self.mute_switch.freeze_notify()
-        self.mute_switch.set_active(not self.remote.get_is_muted())
-        self.mute_switch.thaw_notify()
-
-    def add_inputs(self):
-        model = self.source_combo.get_model()
-        current_input = self.remote.get_source()
-        current_iter = None
-        for source_name in self.remote.get_sources():
-            nice_name = nice_names.get(source_name, source_name)
-            input_iter = model.append([nice_name, source_name])
-            if source_name == current_input:
-                current_iter = input_iter
-        return current_iter
-
-    def on_input_selection_changed(self, combobox):
-        treeiter = combobox.get_active_iter()
-        if treeiter is not None:
-            model = combobox.get_model()
-            name = model[treeiter][1]
-            self.remote.set_source(name)
-            self.update_menu()
-
-    def cell_data_func(self, column, renderer, model, iter_, data):
-        text = model.get(iter_, 0)[0]
-        if text.startswith("- ") and text.endswith(" -"):
-            renderer.set_property("text", text[2:-2])
-            renderer.set_property("weight", Pango.Weight.BOLD)
-        else:
-            renderer.set_property("weight", Pango.Weight.NORMAL)
-
-    def load_menu(self, model, items):
-        for item in items:
-            model.append([item[1], item[0]])
-            yield True
-        self.menu_tree.set_model(model)
-        self.load_id = None
-        yield False
-
-    def update_menu(self):
-        if self.load_id is not None:
-            GObject.source_remove(self.load_id)
-            self.load_id = None
-        model = Gtk.ListStore(str, int)
-        self.menu_tree.set_model(model)
-
-        if self.remote.has_menu():
-            self.menu_box.show()
-            menu_name = self.remote.get_menu_name()
-            if menu_name is None:
-                menu_name = self.remote.get_source()
-            if menu_name.startswith("- ") and menu_name.endswith(" -"):
-                menu_name = menu_name[2:-2]
-            self.current_button.set_label(menu_name)
-            self.load_id = GObject.idle_add(
-                    self.load_menu(model, self.remote.get_menu()).next)
-        else:
-            self.menu_box.hide()
-
-    def on_menu_row_activated(self, tree, path, column):
-        model = tree.get_model()
-        menu_iter = model.get_iter(path)
-        self.remote.select_menu(model[menu_iter][1])
-        self.update_menu()
-
-    def on_parent_button_clicked(self, button):
-        self.remote.menu_return()
-        self.update_menu()
-
-    def on_current_button_clicked(self, button):
-        button.handler_block_by_func(self.on_current_button_clicked)
-        button.set_active(True)
-        button.handler_unblock_by_func(self.on_current_button_clicked)
-
-    def on_repeat_button_clicked(self, button):
-        # Lazy me is lazy
-        repeat_mode = self.remote.get_repeat_mode()
-        modes = ["Off", "One", "All"]
-        index = (modes.index(repeat_mode) + 1) % 3
-        self.remote.set_repeat_mode(modes[index])
-
-    def on_remote_repeat_notify(self, remote, data):
-        repeat_mode = self.remote.get_repeat_mode()
-        self.repeat_button.handler_block_by_func(self.on_repeat_button_clicked)
-        self.repeat_button.set_active(repeat_mode != None and repeat_mode != "Off")
-        self.repeat_button.handler_unblock_by_func(self.on_repeat_button_clicked)
-        if repeat_mode == "One":
-            self.repeat_button.set_label("Repeat One")
-        elif repeat_mode == "All":
-            self.repeat_button.set_label("Repeat All")
-        else:
-            self.repeat_button.set_sensitive(repeat_mode is not None)
-            self.repeat_button.set_label("Repeat")
-
-    def on_shuffle_button_clicked(self, button):
-        # Lazy me is lazy
-        shuffle_mode = self.remote.get_shuffle_mode()
-        source = self.remote.get_source()
-        if source in ["SERVER", "USB", "NET RADIO"]:
-            modes = ["Off", "On"]
-        else:
-            # AirPlay, iPod_USB
-            modes = ["Off", "Songs", "Albums"]
-        index = (modes.index(shuffle_mode) + 1) % len(modes)
-        self.remote.set_shuffle_mode(modes[index])
-
-    def on_remote_shuffle_notify(self, remote, data):
-        shuffle_mode = self.remote.get_shuffle_mode()
-        self.shuffle_button.handler_block_by_func(self.on_shuffle_button_clicked)
-        self.shuffle_button.set_active(shuffle_mode != None and shuffle_mode != "Off")
-        self.shuffle_button.handler_unblock_by_func(self.on_shuffle_button_clicked)
-        if shuffle_mode == "Songs":
-            self.shuffle_button.set_label("Shuffle Songs")
-        elif shuffle_mode == "Albums":
-            self.shuffle_button.set_label("Shuffle Albums")
-        else:
-            self.shuffle_button.set_sensitive(shuffle_mode is not None)
-            self.shuffle_button.set_label("Shuffle")
-
-def on_activate(app):
-    windows = app.get_windows()
-    if len(windows) >= 1:
-        windows[0].present()
+class CommandError(Exception):
+    pass
 
-def on_startup(app):
-    settings = Gtk.Settings.get_default()
-    settings.set_property("gtk-application-prefer-dark-theme", True)
+def parse_switch(value):
+    if value in ("on", "yes", "1"):
+        return True
+    elif value in ("off", "no", "0"):
+        return False
+    raise CommandError("expected on or off, not %r" % value)
+
+def get_status(remote):
+    return {
+        "network_name": remote.network_name,
+        "power": remote.get_is_power_on(),
+        "volume": remote.get_volume(),
+        "muted": remote.get_is_muted(),
+        "source": remote.get_source(),
+        "shuffle": remote.get_shuffle_mode(),
+        "repeat": remote.get_repeat_mode(),
+    }
+
+def cmd_status(remote, args, out):
+    status = get_status(remote)
+    if "--json" in args:
+        print >>out, json.dumps(status, sort_keys=True)
+        return
+    for key in sorted(status):
+        value = status[key]
+        if isinstance(value, bool):
+            value = ["off", "on"][value]
+        print >>out, "%s: %s" % (key, value)
+
+def cmd_power(remote, args, out):
+    if not args:
+        print >>out, ["off", "on"][remote.get_is_power_on()]
+    elif args[0] == "toggle":
+        remote.set_is_power_on(not remote.get_is_power_on())
+    else:
+        remote.set_is_power_on(parse_switch(args[0]))
+
+def cmd_volume(remote, args, out):
+    if not args:
+        print >>out, remote.get_volume()
+        return
+    try:
+        volume = float(args[0])
+    except ValueError:
+        raise CommandError("invalid volume %r" % args[0])
+    remote.set_volume(volume)
+
+def cmd_mute(remote, args, out):
+    if not args:
+        print >>out, ["off", "on"][remote.get_is_muted()]
+    else:
+        remote.set_is_muted(parse_switch(args[0]))
+
+def cmd_input(remote, args, out):
+    if not args:
+        current = remote.get_source()
+        for name in sorted(remote.source_param_names):
+            print >>out, "%s%s" % (["  ", "* "][name == current], name)
+        return
+    name = " ".join(args)
+    if name not in remote.source_param_names:
+        raise CommandError("unknown input %r" % name)
+    remote.set_source(name)
+
+def cmd_menu(remote, args, out):
+    if not remote.has_menu():
+        raise CommandError("%s has no menu" % remote.get_source())
+    if not args or args[0] == "ls":
+        print >>out, remote.get_menu_name()
+        for line, text in remote.get_menu():
+            print >>out, "%5d  %s" % (line, text)
+    elif args[0] == "select" and len(args) == 2:
+        remote.select_menu(int(args[1]))
+    elif args[0] == "back":
+        remote.menu_return()
+    elif args[0] == "go" and len(args) >= 2:
+        path = [int(entry) if entry.isdigit() else entry
+                for entry in " ".join(args[1:]).split("/") if entry]
+        try:
+            remote.navigate(path)
+        except KeyError, e:
+            raise CommandError("no entry %r" % e.args[0])
+    elif args == ["resume"]:
+        snapshot = remote.read_snapshot()
+        if snapshot is not None:
+            remote.load_resume_paths(snapshot)
+        try:
+            if remote.resume_menu() is None:
+                raise CommandError("no folder to resume")
+        except KeyError, e:
+            raise CommandError("no entry %r" % e.args[0])
+    else:
+        raise CommandError(
+                "usage: menu [ls | select LINE | back | go PATH | resume]")
+
+def cmd_playing(remote, args, out):
+    if remote.get_source() not in PLAY_INFO_SOURCES:
+        raise CommandError("%s does not tell what it plays" %
+                remote.get_source())
+    remote.refresh_play_info()
+    info = remote.play_info
+    print >>out, "playback: %s" % info.playback
+    for name in PlayInfo.META_ATTRS:
+        value = getattr(info, name)
+        if value:
+            print >>out, "%s: %s" % (name, value)
+    elapsed = info.get_elapsed()
+    if elapsed is not None and info.playback != "Stop":
+        print >>out, "elapsed: %d:%02d" % divmod(elapsed, 60)
+
+def cmd_favorite(remote, args, out):
+    if not args or args == ["ls"]:
+        for name, favorite in sorted(remote.get_favorites().items()):
+            print >>out, "%-16s %s/%s" % (name, favorite["source"],
+                    "/".join(favorite["path"]))
+    elif len(args) == 2 and args[0] == "save":
+        if not remote.has_menu():
+            raise CommandError("%s has no menu" % remote.get_source())
+        try:
+            remote.save_favorite(args[1])
+        except ValueError, e:
+            raise CommandError(str(e))
+        except KeyError, e:
+            raise CommandError("no entry %r" % e.args[0])
+    elif len(args) == 1:
+        if args[0] not in remote.get_favorites():
+            raise CommandError("unknown favorite %r" % args[0])
+        try:
+            remote.open_favorite(args[0])
+        except KeyError, e:
+            raise CommandError("no entry %r" % e.args[0])
+    else:
+        raise CommandError("usage: favorite [ls | save NAME | NAME]")
+
+def cmd_library(remote, args, out):
+    import medialibrary
+    index = medialibrary.MediaIndex(medialibrary.default_index_path(remote))
+    if args == ["crawl"]:
+        if not remote.has_menu():
+            raise CommandError("%s has no menu" % remote.get_source())
+        crawler = medialibrary.MediaCrawler(remote, index)
+        print >>out, "%d folders listed" % crawler.crawl()
+    elif len(args) >= 2 and args[0] == "search":
+        for source, path, name, is_folder in index.search(" ".join(args[1:])):
+            print >>out, "%-10s %-16s %s%s" % (source,
+                    medialibrary.path_to_string(path), name,
+                    ["", "/"][is_folder])
+    elif len(args) >= 3 and args[0] == "play":
+        source = " ".join(args[1:-1])
+        path = medialibrary.string_to_path(args[-1])
+        names = index.get_names(source, path)
+        if not names:
+            raise CommandError("%s %s is not indexed" % (source, args[-1]))
+        if remote.get_source() != source:
+            remote.set_source(source)
+        try:
+            remote.select_path(path, names)
+        except KeyError, e:
+            raise CommandError("no entry %r" % e.args[0])
+    else:
+        raise CommandError(
+                "usage: library [crawl | search TEXT | play SOURCE PATH]")
+    index.close()
+
+def cmd_scene(remote, args, out):
+    if not args or args == ["ls"]:
+        for name in sorted(remote.get_scenes()):
+            print >>out, name
+    elif len(args) == 2 and args[0] == "save":
+        remote.save_scene(args[1])
+    elif len(args) == 1:
+        if args[0] not in remote.get_scenes():
+            raise CommandError("unknown scene %r" % args[0])
+        remote.apply_scene(args[0])
+    else:
+        raise CommandError("usage: scene [ls | save NAME | NAME]")
+
+COMMANDS = {
+    "favorite": cmd_favorite,
+    "scene": cmd_scene,
+    "library": cmd_library,
+    "status": cmd_status,
+    "power": cmd_power,
+    "volume": cmd_volume,
+    "mute": cmd_mute,
+    "input": cmd_input,
+    "menu": cmd_menu,
+    "playing": cmd_playing,
+}
 
-    win = YamahaRemoteWindow()
-    win.set_application(app)
-    win.show_all()
+# Commands that can control a zone besides Main_Zone.
+ZONE_COMMANDS = ["status", "power", "volume", "mute", "input"]
+
+def run_command(remote, args, out, zone=None):
+    """Run a command line such as ["volume", "-35"].  Returns an exit code."""
+    if not args or args[0] not in COMMANDS:
+        print >>out, "Unknown command. Commands: %s" % ", ".join(sorted(COMMANDS))
+        return 2
+    if zone not in (None, "Main_Zone"):
+        if args[0] not in ZONE_COMMANDS:
+            print >>out, "Error: %s does not apply to a zone" % args[0]
+            return 2
+        try:
+            remote = remote.get_zone(zone)
+        except KeyError:
+            print >>out, "Error: %s is not in use on %s" % (zone,
+                    remote.network_name or remote.address)
+            return 1
+    try:
+        COMMANDS[args[0]](remote, args[1:], out)
+    except (CommandError, MenuTimeoutError, RequestRefusedError,
+            pycurl.error), e:
+        print >>out, "Error: %s" % (e,)
+        return 1
+    return 0
+
+def find_receivers(group, names, refresh):
+    """Return the remotes of group called names.
+
+    names are addresses or network names; ["all"] means every receiver and
+    no names the first one.  Network names are only known once refresh()
+    was called, which is done here when needed.
+    """
+    remotes = group.remotes.values()
+    if not names:
+        return remotes[:1]
+    if names == ["all"]:
+        return remotes
+    if any(name not in group.remotes for name in names):
+        group.run_all(refresh, [remote for remote in remotes
+                if remote.network_name is None])
+    try:
+        return [group.find(name) for name in names]
+    except KeyError, e:
+        raise CommandError("unknown receiver %r" % e.args[0])
+
+def run_group_command(group, names, args, out, refresh, zone=None):
+    """Run a command line on several receivers at once.
+
+    refresh(remote) is called before the command on each receiver.  When
+    there is more than one, each output is preceded by the receiver name.
+    Returns the worst exit code.
+    """
+    try:
+        remotes = find_receivers(group, names, refresh)
+    except CommandError, e:
+        print >>out, "Error: %s" % (e,)
+        return 2
+
+    def run(remote):
+        buf = cStringIO.StringIO()
+        try:
+            refresh(remote)
+        except pycurl.error, e:
+            print >>buf, "Error: %s" % (e,)
+            return 1, buf.getvalue()
+        return run_command(remote, args, buf, zone), buf.getvalue()
+
+    status = 0
+    for remote, result, error in group.run_all(run, remotes):
+        if len(remotes) > 1:
+            print >>out, "[%s]" % (remote.network_name or remote.address)
+        if error is not None:
+            result = 1, "Error: %s\n" % (error,)
+        code, output = result
+        out.write(output)
+        status = max(status, code)
+    return status
+
+def default_socket_path():
+    runtime_dir = os.environ.get("XDG_RUNTIME_DIR")
+    if runtime_dir:
+        return os.path.join(runtime_dir, "yamaharemote.sock")
+    return "/tmp/yamaharemote-%d.sock" % os.getuid()
+
+# How old the daemon's state may be before a command refreshes it.
+DAEMON_STATE_MAX_AGE = 2.0
+
+class DaemonHandler(SocketServer.StreamRequestHandler):
+    """Answers one JSON-encoded command with a JSON reply.
+
+    A command is either a command line or an object with the command line
+    in "args", the names of the receivers to run it on in "receivers" and
+    the zone to control in "zone".
+    """
+
+    def handle(self):
+        request = json.loads(self.rfile.readline())
+        if isinstance(request, list):
+            request = {"args": request}
+        out = cStringIO.StringIO()
+        status = run_group_command(self.server.group,
+                request.get("receivers"), request["args"], out,
+                self.server.refresh, request.get("zone"))
+        self.wfile.write(json.dumps({"status": status,
+                "output": out.getvalue()}) + "\n")
+
+class Daemon(SocketServer.UnixStreamServer):
+    """Keeps warm connections and the receivers' state between commands."""
+
+    def __init__(self, group, path):
+        if os.path.exists(path):
+            os.unlink(path)
+        SocketServer.UnixStreamServer.__init__(self, path, DaemonHandler)
+        self.group = group
+        self.refreshed = {}
+
+    def refresh(self, remote):
+        if time.time() - self.refreshed.get(remote.address, 0.0) > \
+                DAEMON_STATE_MAX_AGE:
+            remote.refresh()
+            self.refreshed[remote.address] = time.time()
+
+def send_to_daemon(path, args, receivers=None, zone=None):
+    """Run a command through the daemon.  Returns None if none is running."""
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except socket.error:
+        sock.close()
+        return None
+    f = sock.makefile("rw")
+    f.write(json.dumps({"args": args, "receivers": receivers,
+            "zone": zone}) + "\n")
+    f.flush()
+    reply = json.loads(f.readline())
+    sock.close()
+    sys.stdout.write(reply["output"])
+    return reply["status"]
+
+def main(argv):
+    if len(argv) < 2:
+        import yamaharemotegui
+        return yamaharemotegui.main(argv)
+
+    parser = optparse.OptionParser(
+            usage="%prog [options] [daemon | COMMAND [ARGS...]]\n\n"
+            "Without a command, the graphical remote is started.\n"
+            "Commands: " + ", ".join(sorted(COMMANDS)))
+    parser.disable_interspersed_args()
+    parser.add_option("--address",
+            help="receiver address, instead of the configured receivers")
+    parser.add_option("-r", "--receivers", metavar="NAMES",
+            help="comma-separated addresses or network names of the "
+            "receivers to control, or \"all\" [default: the first one]")
+    parser.add_option("-z", "--zone", choices=["Main_Zone"] + ZONES,
+            help="zone to control with %s" % ", ".join(ZONE_COMMANDS))
+    parser.add_option("--socket", default=default_socket_path(),
+            help="daemon socket [default: %default]")
+    parser.add_option("--no-daemon", action="store_true",
+            help="talk to the receiver directly, even if a daemon is running")
+    options, args = parser.parse_args(argv[1:])
+    names = options.receivers.split(",") if options.receivers else []
+    addresses = [options.address] if options.address else None
+
+    if args == ["daemon"]:
+        server = Daemon(ReceiverGroup(addresses), options.socket)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        os.unlink(options.socket)
+        return 0
+
+    if not options.no_daemon and addresses is None:
+        status = send_to_daemon(options.socket, args, names, options.zone)
+        if status is not None:
+            return status
+
+    refreshed = set()
+    def refresh(remote):
+        if remote.address not in refreshed:
+            remote.refresh()
+            refreshed.add(remote.address)
+
+    group = ReceiverGroup(addresses)
+    return run_group_command(group, names, args, sys.stdout, refresh,
+            options.zone)
 
 if __name__ == '__main__':
-    app = Gtk.Application(application_id="ca.deuxpi.YamahaRemote")
-    app.connect("activate", on_activate)
-    app.connect("startup", on_startup)
-    app.run(sys.argv)
+    sys.exit(main(sys.argv))
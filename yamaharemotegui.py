@@ -0,0 +1,1103 @@
+# Copyright (c) 2013 Philippe Gauthier
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import sys
+import time
+import itertools
+import threading
+import collections
+
+import medialibrary
+
+from gi.repository import GObject, GLib, Gdk, GdkPixbuf, Gtk, Pango
+
+from yamaharemote import ReceiverGroup, CancellationToken, nice_names
+from yamaharemote import ReceiverOfflineError
+from yamaharemote import SNAPSHOT_MENU_ITEMS, PRIORITY_MENU
+
+# Menus with more lines than this are loaded on demand.
+LAZY_MENU_THRESHOLD = 200
+# Number of pages a lazy menu keeps around the ones last displayed.
+LAZY_MENU_PAGES = 32
+# Time spent appending menu rows per main loop iteration, in seconds.
+MENU_INSERT_BUDGET = 0.008
+# Most menu rows appended per main loop iteration.
+MENU_INSERT_BATCH = 256
+# Size of the album art shown with what is playing, in pixels.
+ALBUM_ART_SIZE = 64
+
+class LazyMenuModel(GObject.GObject, Gtk.TreeModel):
+    """A menu model that only fetches the pages being displayed.
+
+    The number of rows is known from Max_Line, so the view can be scrolled
+    right away.  Rows show a placeholder until the tree view asks for their
+    value, which fetches their page and the next one in the background.
+    Only the LAZY_MENU_PAGES most recently displayed pages are kept.
+    """
+
+    PLACEHOLDER = "..."
+
+    def __init__(self, remote, folder, max_line, token):
+        GObject.GObject.__init__(self)
+        self.remote = remote
+        self.folder = folder
+        self.max_line = max_line
+        self.token = token
+        self.pages = collections.OrderedDict()
+        self.requested = set()
+
+    def request_page(self, first):
+        if first in self.requested or first > self.max_line:
+            return
+        self.requested.add(first)
+        self.remote.call_async(self.remote.get_menu_page, self.folder,
+                self.max_line, first, priority=PRIORITY_MENU, token=self.token,
+                callback=lambda entries: self.on_page(first, entries),
+                error_callback=lambda error: self.requested.discard(first))
+
+    def on_page(self, first, entries):
+        self.requested.discard(first)
+        if entries is None:
+            return
+        self.pages[first] = dict((line, text) for line, text, attribute in entries)
+        while len(self.pages) > LAZY_MENU_PAGES:
+            self.pages.popitem(last=False)
+        for line in range(first, min(first + 8, self.max_line + 1)):
+            path = Gtk.TreePath((line - 1,))
+            self.row_changed(path, self.get_iter(path))
+
+    def _make_iter(self, index):
+        it = Gtk.TreeIter()
+        # user_data is a pointer, so index 0 would come back as None.
+        it.user_data = index + 1
+        return it
+
+    def do_get_flags(self):
+        return Gtk.TreeModelFlags.LIST_ONLY | Gtk.TreeModelFlags.ITERS_PERSIST
+
+    def do_get_n_columns(self):
+        return 2
+
+    def do_get_column_type(self, column):
+        return (GObject.TYPE_STRING, GObject.TYPE_INT)[column]
+
+    def do_get_iter(self, path):
+        index = path.get_indices()[0]
+        if 0 <= index < self.max_line:
+            return True, self._make_iter(index)
+        return False, None
+
+    def do_get_path(self, it):
+        return Gtk.TreePath((it.user_data - 1,))
+
+    def get_loaded_rows(self, line, limit):
+        """Return up to limit (line, text) rows from the page of line on.
+
+        Only loaded pages are used, so nothing is fetched; the rows stop at
+        the first page that is not loaded.
+        """
+        rows = []
+        first = (line - 1) // 8 * 8 + 1
+        while first in self.pages and len(rows) < limit:
+            rows += sorted(self.pages[first].items())
+            first += 8
+        return rows[:limit]
+
+    def do_get_value(self, it, column):
+        line = it.user_data
+        if column == 1:
+            return line
+        first = (line - 1) // 8 * 8 + 1
+        page = self.pages.get(first)
+        if page is None:
+            self.request_page(first)
+            self.request_page(first + 8)
+            return self.PLACEHOLDER
+        # Keep pages on screen from being dropped.
+        self.pages[first] = self.pages.pop(first)
+        return page.get(line, "")
+
+    def do_iter_next(self, it):
+        if it.user_data < self.max_line:
+            return True, self._make_iter(it.user_data)
+        return False, None
+
+    def do_iter_previous(self, it):
+        if it.user_data > 1:
+            return True, self._make_iter(it.user_data - 2)
+        return False, None
+
+    def do_iter_children(self, parent):
+        if parent is None and self.max_line > 0:
+            return True, self._make_iter(0)
+        return False, None
+
+    def do_iter_has_child(self, it):
+        return False
+
+    def do_iter_n_children(self, it):
+        if it is None:
+            return self.max_line
+        return 0
+
+    def do_iter_nth_child(self, parent, n):
+        if parent is None and 0 <= n < self.max_line:
+            return True, self._make_iter(n)
+        return False, None
+
+    def do_iter_parent(self, child):
+        return False, None
+
+def restore_scroll(adjustment, value):
+    """Scroll to value as soon as the view is long enough.
+
+    Rows are laid out some time after they are added, so this waits for
+    the adjustment to grow.  Returns the signal handler, to disconnect it
+    if the view changes first.
+    """
+    def on_changed(adjustment):
+        if adjustment.get_upper() - adjustment.get_page_size() >= value:
+            adjustment.set_value(value)
+            adjustment.disconnect(handler[0])
+            handler[0] = None
+    handler = [adjustment.connect("changed", on_changed)]
+    return handler
+
+class MenuInserter(object):
+    """Appends menu entries to a list store from an idle handler.
+
+    Entries are queued as pages arrive and appended in batches bounded by
+    MENU_INSERT_BUDGET and MENU_INSERT_BATCH, so that a burst of cached
+    pages costs one dispatch per frame and never delays drawing.  The idle
+    priority is below redraws, so the rows added so far are shown between
+    batches.  The row of the selected line, if any, is selected when it
+    is added.
+    """
+
+    def __init__(self, tree, model, selected=None):
+        self.tree = tree
+        self.model = model
+        self.selected = selected
+        self.pending = collections.deque()
+        self.source_id = None
+
+    def add(self, entries):
+        self.pending.extend(entries)
+        if self.source_id is None:
+            self.source_id = GObject.idle_add(self.on_idle)
+
+    def cancel(self):
+        self.pending.clear()
+        if self.source_id is not None:
+            GObject.source_remove(self.source_id)
+            self.source_id = None
+
+    def on_idle(self):
+        deadline = time.time() + MENU_INSERT_BUDGET
+        count = 0
+        while self.pending and count < MENU_INSERT_BATCH:
+            entry = self.pending.popleft()
+            menu_iter = self.model.append([entry[1], entry[0]])
+            if entry[0] == self.selected:
+                self.tree.get_selection().select_iter(menu_iter)
+                self.selected = None
+            count += 1
+            if count % 16 == 0 and time.time() > deadline:
+                break
+        if self.pending:
+            return True
+        self.source_id = None
+        return False
+
+class StallWatchdog(object):
+    """Reports main loop iterations that take longer than threshold seconds.
+
+    A high priority timeout stamps every iteration of the main loop, and a
+    thread samples the stack of the main thread while the stamp is late.
+    When the loop comes back, the stall is reported with the handler it was
+    spent in, the remote calls made from it and their round trips.  The
+    watchdog must be created from the function that runs the main loop, so
+    that it knows which frames belong to handlers.
+    """
+
+    def __init__(self, threshold, interval=0.01, out=sys.stderr):
+        self.threshold = threshold
+        self.interval = interval
+        self.out = out
+        self.thread_id = threading.current_thread().ident
+        self.depth = len(self._frames(sys._getframe(1)))
+        self.lock = threading.Lock()
+        self.last_beat = time.time()
+        self.samples = []
+        self.round_trips = []
+        self.stopped = False
+        GObject.timeout_add(int(interval * 1000), self.on_beat,
+                priority=GObject.PRIORITY_HIGH)
+        thread = threading.Thread(target=self.run_sampler)
+        thread.daemon = True
+        thread.start()
+
+    def watch(self, remote):
+        remote.stats.listeners.append(self.on_request)
+
+    def stop(self):
+        self.stopped = True
+
+    @staticmethod
+    def _frames(frame):
+        frames = []
+        while frame is not None:
+            code = frame.f_code
+            frames.append((os.path.basename(code.co_filename), frame.f_lineno,
+                    code.co_name))
+            frame = frame.f_back
+        frames.reverse()
+        return frames
+
+    def on_request(self, cmd, kind, total_time, error_code):
+        if threading.current_thread().ident == self.thread_id:
+            with self.lock:
+                self.round_trips.append("%s %s" % (cmd, kind))
+
+    def run_sampler(self):
+        while not self.stopped:
+            time.sleep(self.interval)
+            if time.time() - self.last_beat < self.threshold / 2:
+                continue
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is not None:
+                sample = self._frames(frame)[self.depth:]
+                with self.lock:
+                    self.samples.append(sample)
+
+    def on_beat(self):
+        now = time.time()
+        stall = now - self.last_beat - self.interval
+        with self.lock:
+            samples, self.samples = self.samples, []
+            round_trips, self.round_trips = self.round_trips, []
+        self.last_beat = now
+        if stall > self.threshold:
+            self.report(stall, samples, round_trips)
+        return not self.stopped
+
+    def report(self, stall, samples, round_trips):
+        handlers = collections.Counter()
+        calls = collections.OrderedDict()
+        stacks = collections.Counter()
+        for sample in samples:
+            if not sample:
+                continue
+            handlers["%s (%s:%d)" % (sample[0][2], sample[0][0],
+                    sample[0][1])] += 1
+            stacks[tuple(sample)] += 1
+            for filename, line, name in sample:
+                if filename == "yamaharemote.py":
+                    calls[name] = None
+                    break
+        out = self.out
+        handler = handlers.most_common(1)[0][0] if handlers else "unknown"
+        print >>out, "main loop stalled %.0f ms in %s" % (stall * 1000,
+                handler)
+        if calls:
+            print >>out, "  remote calls: %s" % ", ".join(calls)
+        if round_trips:
+            print >>out, "  %d round trips: %s" % (len(round_trips),
+                    ", ".join("%s x%d" % item if item[1] > 1 else item[0]
+                        for item in collections.Counter(round_trips).items()))
+        if stacks:
+            stack, count = stacks.most_common(1)[0]
+            print >>out, "  most sampled stack (%d of %d samples):" % (count,
+                    len(samples))
+            for filename, line, name in stack:
+                print >>out, "    %s:%d %s" % (filename, line, name)
+
+class YamahaRemoteWindow(Gtk.Window):
+    def __init__(self):
+        Gtk.Window.__init__(self, title="Yamaha Remote Control")
+        self.set_size_request(500, -1)
+        self.set_resizable(False)
+        self.set_border_width(12)
+
+        self.menu_token = None
+        self.menu_inserter = None
+        self.menu_scroll_handler = None
+        self.menu_folder = None
+        self.menu_view = None
+        # MediaCrawler indexing the current source in the background.
+        self.crawler = None
+        self.remote = None
+        self.remote_handlers = []
+        # Whether the initial refresh failed and must be done again.
+        self.initial_state_failed = False
+        self.play_info_handler = None
+        self.play_timer_id = None
+        # The album art data shown, so that it is only decoded once.
+        self.shown_art = None
+        self.iconified = False
+        self.group = ReceiverGroup()
+
+        vbox = Gtk.Box(orientation=Gtk.Orientation.VERTICAL, spacing=18)
+        self.add(vbox)
+
+        system_box = Gtk.Box(spacing=12)
+        vbox.pack_start(system_box, False, False, 0)
+
+        image = Gtk.Image.new_from_icon_name("audio-speakers", Gtk.IconSize.DIALOG)
+        system_box.pack_start(image, False, False, 0)
+
+        self.name_label = Gtk.Label()
+        self.name_label.set_markup("<b>Receiver</b>")
+        system_box.pack_start(self.name_label, False, False, 0)
+
+        # Only shown when several receivers are configured.
+        self.receiver_combo = Gtk.ComboBoxText()
+        self.receiver_combo.set_no_show_all(True)
+        for address in self.group.remotes:
+            self.receiver_combo.append(address, address)
+        self.receiver_combo.connect("changed", self.on_receiver_changed)
+        system_box.pack_start(self.receiver_combo, False, False, 0)
+
+        power_box = Gtk.Alignment(xalign=1.0, yalign=0.5, xscale=0.0, yscale=0.0)
+        self.power_switch = Gtk.Switch()
+        self.power_switch.set_active(True)
+        self.power_switch.connect('notify::active', self.on_power_notify)
+        power_box.add(self.power_switch)
+        system_box.pack_start(power_box, True, True, 0)
+
+        # Only shown while something plays.
+        self.play_box = Gtk.Box(spacing=12)
+        self.play_box.set_no_show_all(True)
+        vbox.pack_start(self.play_box, False, False, 0)
+
+        self.art_image = Gtk.Image()
+        self.art_image.set_size_request(ALBUM_ART_SIZE, ALBUM_ART_SIZE)
+        self.art_image.show()
+        self.play_box.pack_start(self.art_image, False, False, 0)
+
+        labels_box = Gtk.Box(orientation=Gtk.Orientation.VERTICAL, spacing=2)
+        self.song_label = Gtk.Label()
+        self.details_label = Gtk.Label()
+        self.time_label = Gtk.Label()
+        for label in (self.song_label, self.details_label, self.time_label):
+            label.set_alignment(0.0, 0.5)
+            label.set_ellipsize(Pango.EllipsizeMode.END)
+            labels_box.pack_start(label, False, False, 0)
+        labels_box.show_all()
+        self.play_box.pack_start(labels_box, True, True, 0)
+
+        volume_box = Gtk.Box(spacing=12)
+        alignment = Gtk.Alignment(xalign=0, yalign=0, xscale=1, yscale=1)
+        alignment.add(volume_box)
+        vbox.pack_start(alignment, False, False, 0)
+
+        label = Gtk.Label()
+        label.set_label("Volume:")
+        label.set_alignment(0.0, 0.5)
+        volume_box.pack_start(label, False, False, 0)
+
+        adj = Gtk.Adjustment(-40.0, -80.0, 16.0, 0.5, 5.0, 0.0)
+        self.volume_bar = Gtk.Scale(orientation=Gtk.Orientation.HORIZONTAL,
+                adjustment=adj)
+        self.volume_bar.set_size_request(128, -1)
+        self.volume_bar.set_draw_value(False)
+        self.volume_bar.add_mark(0.0, Gtk.PositionType.BOTTOM,
+                "<small>100%</small>")
+        adj.connect('value-changed', self.on_volume_changed)
+        volume_box.pack_start(self.volume_bar, True, True, 0)
+
+        mute_box = Gtk.Alignment(xalign=0.5, yalign=0.0, xscale=0.0, yscale=0.0)
+        self.mute_switch = Gtk.Switch()
+        self.mute_switch.set_active(True)
+        self.mute_switch.connect('notify::active', self.on_is_muted_notify)
+        mute_box.add(self.mute_switch)
+        volume_box.pack_start(mute_box, False, False, 0)
+
+        input_box = Gtk.Box(spacing=12)
+        vbox.pack_start(input_box, True, True, 0)
+
+        label = Gtk.Label("Source:")
+        input_box.pack_start(label, False, False, 0)
+
+        store = Gtk.ListStore(str, str)
+        self.source_combo = Gtk.ComboBox.new_with_model(store)
+        self.source_combo.connect("changed", self.on_input_selection_changed)
+        input_box.pack_start(self.source_combo, True, True, 0)
+        renderer = Gtk.CellRendererText()
+        self.source_combo.pack_start(renderer, True)
+        self.source_combo.add_attribute(renderer, "text", 0)
+
+        self.menu_box = Gtk.Box(orientation=Gtk.Orientation.VERTICAL, spacing=12)
+        self.menu_box.set_no_show_all(True)
+        vbox.pack_start(self.menu_box, False, False, 0)
+
+        box = Gtk.Box(spacing=12)
+        box.show()
+        self.menu_box.pack_start(box, True, True, 0)
+
+        alignment = Gtk.Alignment(xalign=0.0)
+        alignment.show()
+        box.pack_start(alignment, True, True, 0)
+        path_bar = Gtk.Box()
+        path_bar.get_style_context().add_class("linked")
+        path_bar.show()
+        alignment.add(path_bar)
+
+        self.parent_button = Gtk.Button()
+        self.parent_button.set_focus_on_click(False)
+        self.parent_button.show()
+        arrow = Gtk.Arrow(Gtk.ArrowType.LEFT, Gtk.ShadowType.OUT)
+        arrow.show()
+        self.parent_button.add(arrow)
+        self.parent_button.connect("clicked", self.on_parent_button_clicked)
+        path_bar.add(self.parent_button)
+
+        self.current_button = Gtk.ToggleButton("Current")
+        self.current_button.set_focus_on_click(False)
+        self.current_button.set_active(True)
+        self.current_button.connect("clicked", self.on_current_button_clicked)
+        self.current_button.show()
+        path_bar.add(self.current_button)
+
+        alignment = Gtk.Alignment(xalign=1.0, xscale=1.0)
+        alignment.show()
+        box.pack_start(alignment, False, False, 0)
+        button_box = Gtk.Box(spacing=6)
+        button_box.show()
+        alignment.add(button_box)
+        self.repeat_button = Gtk.ToggleButton("Repeat")
+        self.repeat_button.connect("clicked", self.on_repeat_button_clicked)
+        self.repeat_button.show()
+        button_box.pack_start(self.repeat_button, False, False, 0)
+        self.shuffle_button = Gtk.ToggleButton("Shuffle")
+        self.shuffle_button.connect("clicked", self.on_shuffle_button_clicked)
+        self.shuffle_button.show()
+        button_box.pack_start(self.shuffle_button, False, False, 0)
+        self.index_button = Gtk.ToggleButton("Index")
+        self.index_button.set_tooltip_text("Index this source for search")
+        self.index_button.connect("clicked", self.on_index_button_clicked)
+        self.index_button.show()
+        button_box.pack_start(self.index_button, False, False, 0)
+
+        scrolled = Gtk.ScrolledWindow()
+        scrolled.set_policy(Gtk.PolicyType.NEVER, Gtk.PolicyType.AUTOMATIC)
+        scrolled.set_shadow_type(Gtk.ShadowType.IN)
+        scrolled.set_min_content_height(250)
+        scrolled.show()
+        self.menu_box.pack_start(scrolled, True, True, 0)
+        self.menu_adjustment = scrolled.get_vadjustment()
+
+        self.menu_tree = Gtk.TreeView()
+        self.menu_tree.set_rules_hint(True)
+        self.menu_tree.set_headers_visible(False)
+        self.menu_tree.connect("row-activated", self.on_menu_row_activated)
+        self.menu_tree.show()
+        scrolled.add(self.menu_tree)
+
+        renderer = Gtk.CellRendererText()
+        renderer.set_property("ellipsize", Pango.EllipsizeMode.END);
+        self.menu_column = Gtk.TreeViewColumn("Text", renderer, text=0)
+        self.menu_column.set_cell_data_func(renderer, self.cell_data_func)
+        self.menu_tree.append_column(self.menu_column)
+
+        self.connect("destroy", self.on_destroy)
+        self.connect("notify::is-active", self.on_is_active_notify)
+        self.connect("map", self.on_map_changed)
+        self.connect("unmap", self.on_map_changed)
+        self.connect("window-state-event", self.on_window_state_event)
+
+        if len(self.group.remotes) > 1:
+            self.receiver_combo.show()
+        self.receiver_combo.set_active(0)
+
+    def set_remote(self, remote):
+        """Control another receiver.
+
+        Each receiver keeps its worker and connection, so switching back
+        and forth is cheap.
+        """
+        if self.remote is not None:
+            self.cancel_menu()
+            self.stop_indexing()
+            self.end_indexing()
+            self.remote.sync.stop()
+            self.save_snapshot()
+            for handler in self.remote_handlers:
+                self.remote.disconnect(handler)
+            self.remote.play_info.disconnect(self.play_info_handler)
+            self.remote.play_info.set_watched(False)
+        self.remote = remote
+        self.initial_state_failed = False
+        self.remote_handlers = [remote.connect(signal, handler)
+                for signal, handler in [
+                    ("notify::volume", self.on_remote_volume_notify),
+                    ("notify::muted", self.on_remote_muted_notify),
+                    ("notify::power", self.on_remote_power_notify),
+                    ("notify::repeat", self.on_remote_repeat_notify),
+                    ("notify::shuffle", self.on_remote_shuffle_notify),
+                    ("notify::source", self.on_remote_source_notify),
+                    ("notify::online", self.on_remote_online_notify)]]
+        self.on_remote_online_notify(remote, None)
+        self.play_info_handler = remote.play_info.connect("notify",
+                self.on_play_info_notify)
+        self.update_play_info_watched()
+        self.show_play_info()
+
+        # Show the last known state until the receiver answers.
+        self.name_label.set_markup("<b>Receiver</b>")
+        self.menu_folder = None
+        self.set_menu_model(None)
+        self.menu_box.hide()
+        # The snapshot's menu is shown as is; loading the menu of the
+        # restored source would block on the receiver, since the worker is
+        # not running yet, and the sources are not known yet.
+        remote.handler_block_by_func(self.on_remote_source_notify)
+        snapshot = remote.load_snapshot()
+        remote.handler_unblock_by_func(self.on_remote_source_notify)
+        if snapshot is not None:
+            self.show_receiver(snapshot.get("network_name"),
+                    sorted(snapshot.get("source_param_names", {}).keys()))
+            self.show_menu_snapshot(snapshot.get("menu"))
+
+        remote.start_worker()
+        self.request_initial_state()
+
+    def request_initial_state(self):
+        remote = self.remote
+        self.initial_state_failed = False
+        remote.call_async(self.fetch_initial_state, remote,
+                callback=self.on_initial_state,
+                error_callback=lambda error:
+                    self.on_initial_state_error(remote, error))
+
+    def on_receiver_changed(self, combo):
+        self.set_remote(self.group.remotes[combo.get_active_id()])
+
+    def fetch_initial_state(self, remote):
+        # Runs on the remote worker thread.
+        remote.refresh()
+        return (remote, remote.network_name,
+                sorted(remote.source_param_names.keys()))
+
+    def on_initial_state(self, state):
+        remote, network_name, sources = state
+        if remote is not self.remote:
+            return
+        self.show_receiver(network_name, sources)
+        if self.remote.has_menu() and \
+                self.remote.resume_paths.get(self.remote.source):
+            # Reopen the folder of the last session before listing it.
+            self.remote.call_async(self.remote.resume_menu,
+                    priority=PRIORITY_MENU, callback=self.on_menu_changed,
+                    error_callback=self.on_resume_menu_error)
+        else:
+            self.update_menu()
+        self.remote.sync.start()
+
+    def on_initial_state_error(self, remote, error):
+        if remote is not self.remote:
+            return
+        if not isinstance(error, ReceiverOfflineError):
+            print >>sys.stderr, "Warning: %s" % error
+        # The status polls find out when the receiver is back, and the
+        # refresh is then done again.
+        self.initial_state_failed = True
+        self.remote.sync.start()
+
+    def on_is_active_notify(self, window, data):
+        self.remote.sync.set_active(self.is_active())
+
+    def on_map_changed(self, window):
+        self.update_play_info_watched()
+
+    def on_window_state_event(self, window, event):
+        self.iconified = bool(event.new_window_state &
+                Gdk.WindowState.ICONIFIED)
+        self.update_play_info_watched()
+        return False
+
+    def update_play_info_watched(self):
+        # Play_Info is only polled while it can be seen.
+        watched = self.get_mapped() and not self.iconified
+        if self.remote is not None and watched != self.remote.play_info.watched:
+            self.remote.play_info.set_watched(watched)
+            self.update_play_timer()
+
+    def on_play_info_notify(self, play_info, pspec):
+        self.show_play_info()
+
+    def show_play_info(self):
+        info = self.remote.play_info
+        if info.playback == "Stop":
+            self.play_box.hide()
+            self.update_play_timer()
+            return
+        self.song_label.set_markup("<b>%s</b>" %
+                GLib.markup_escape_text(info.song or ""))
+        self.details_label.set_text(" - ".join(text
+                for text in (info.artist, info.album) if text))
+        if info.art is not self.shown_art:
+            self.shown_art = info.art
+            self.art_image.set_from_pixbuf(self.load_album_art(info.art))
+        self.update_play_time()
+        self.play_box.show()
+        self.update_play_timer()
+
+    def load_album_art(self, data):
+        if not data:
+            return None
+        loader = GdkPixbuf.PixbufLoader()
+        try:
+            loader.write(data)
+            loader.close()
+        except GLib.GError:
+            return None
+        pixbuf = loader.get_pixbuf()
+        return pixbuf.scale_simple(ALBUM_ART_SIZE, ALBUM_ART_SIZE,
+                GdkPixbuf.InterpType.BILINEAR)
+
+    def update_play_time(self):
+        info = self.remote.play_info
+        elapsed = info.get_elapsed()
+        text = "" if elapsed is None else "%d:%02d" % divmod(elapsed, 60)
+        if info.playback == "Pause":
+            text = (text + " (paused)").strip()
+        self.time_label.set_text(text)
+
+    def update_play_timer(self):
+        # The elapsed time is counted here; polls only correct it.
+        running = (self.remote.play_info.watched and
+                self.remote.play_info.playback == "Play")
+        if running and self.play_timer_id is None:
+            self.play_timer_id = GObject.timeout_add(1000, self.on_play_timer)
+        elif not running and self.play_timer_id is not None:
+            GObject.source_remove(self.play_timer_id)
+            self.play_timer_id = None
+
+    def on_play_timer(self):
+        self.update_play_time()
+        return True
+
+    def on_remote_online_notify(self, remote, data):
+        # Keep showing the last known state, but not as something that can
+        # be changed.  The status polls find out when the receiver is back.
+        online = self.remote.is_online()
+        for widget in (self.power_switch, self.volume_bar, self.mute_switch,
+                self.source_combo, self.menu_box):
+            widget.set_sensitive(online)
+        if online and self.initial_state_failed:
+            self.request_initial_state()
+
+    def show_receiver(self, network_name, sources):
+        if network_name:
+            self.name_label.set_markup("<b>%s</b>" % network_name)
+            for row in self.receiver_combo.get_model():
+                if row[1] == self.remote.address:
+                    row[0] = network_name
+        self.source_combo.handler_block_by_func(self.on_input_selection_changed)
+        self.source_combo.get_model().clear()
+        input_iter = self.add_inputs(sources)
+        if input_iter is not None:
+            self.source_combo.set_active_iter(input_iter)
+        self.source_combo.handler_unblock_by_func(self.on_input_selection_changed)
+
+    def show_menu_snapshot(self, menu):
+        if menu is None or not self.remote.has_menu():
+            return
+        model = Gtk.ListStore(str, int)
+        for line, text in menu["items"]:
+            model.append([text, line])
+        self.set_menu_model(model)
+        self.current_button.set_label(menu["name"])
+        self.menu_box.show()
+
+    def on_destroy(self, window):
+        self.stop_indexing()
+        self.save_snapshot()
+
+    def save_snapshot(self):
+        menu = None
+        model = self.menu_tree.get_model()
+        if model is not None and self.remote.has_menu():
+            if isinstance(model, LazyMenuModel):
+                # Reading other rows would show placeholders and fetch them.
+                visible = self.menu_tree.get_visible_range()
+                line = visible[0].get_indices()[0] + 1 if visible else 1
+                rows = model.get_loaded_rows(line, SNAPSHOT_MENU_ITEMS)
+            else:
+                rows = [(row[1], row[0]) for row in
+                        itertools.islice(model, SNAPSHOT_MENU_ITEMS)]
+            menu = (self.current_button.get_label(), rows)
+        self.remote.save_snapshot(menu)
+
+    def on_power_notify(self, switch, data):
+        self.remote.sync.touch()
+        self.remote.set_is_power_on(switch.get_active())
+
+    def on_remote_power_notify(self, remote, data):
+        self.power_switch.freeze_notify()
+        self.power_switch.set_active(self.remote.get_is_power_on())
+        self.power_switch.thaw_notify()
+
+    def on_volume_changed(self, adjustment):
+        volume = adjustment.get_value()
+        self.remote.sync.touch()
+        self.remote.set_volume(volume)
+
+    def on_remote_volume_notify(self, remote, data):
+        adj = self.volume_bar.get_adjustment()
+        adj.handler_block_by_func(self.on_volume_changed)
+        adj.set_value(self.remote.get_volume())
+        adj.handler_unblock_by_func(self.on_volume_changed)
+
+    def on_is_muted_notify(self, switch, active):
+        self.remote.sync.touch()
+        self.remote.set_is_muted(not switch.get_active())
+
+    def on_remote_muted_notify(self, remote, data):
+        self.mute_switch.freeze_notify()
+        self.mute_switch.set_active(not self.remote.get_is_muted())
+        self.mute_switch.thaw_notify()
+
+    def add_inputs(self, sources):
+        model = self.source_combo.get_model()
+        current_input = self.remote.get_source()
+        current_iter = None
+        for source_name in sources:
+            nice_name = nice_names.get(source_name, source_name)
+            input_iter = model.append([nice_name, source_name])
+            if source_name == current_input:
+                current_iter = input_iter
+        return current_iter
+
+    def on_remote_source_notify(self, remote, data):
+        # Only follow changes made elsewhere; ours already update the menu.
+        source = self.remote.get_source()
+        treeiter = self.source_combo.get_active_iter()
+        model = self.source_combo.get_model()
+        if treeiter is not None and model[treeiter][1] == source:
+            return
+        self.source_combo.handler_block_by_func(self.on_input_selection_changed)
+        for row in model:
+            if row[1] == source:
+                self.source_combo.set_active_iter(row.iter)
+        self.source_combo.handler_unblock_by_func(self.on_input_selection_changed)
+        self.update_menu()
+
+    def on_input_selection_changed(self, combobox):
+        treeiter = combobox.get_active_iter()
+        if treeiter is not None:
+            model = combobox.get_model()
+            name = model[treeiter][1]
+            self.cancel_menu()
+            self.remote.sync.touch()
+            self.remote.set_source(name, callback=self.on_menu_changed)
+
+    def cell_data_func(self, column, renderer, model, iter_, data):
+        text = model.get(iter_, 0)[0]
+        if text.startswith("- ") and text.endswith(" -"):
+            renderer.set_property("text", text[2:-2])
+            renderer.set_property("weight", Pango.Weight.BOLD)
+        else:
+            renderer.set_property("weight", Pango.Weight.NORMAL)
+
+    def on_menu_size(self, token, model, size):
+        folder, max_line = size
+        selected = scroll = None
+        if self.menu_view is not None and self.menu_view[0] == folder:
+            selected, scroll = self.menu_view[1:]
+        self.menu_folder = folder
+        if scroll:
+            self.menu_scroll_handler = restore_scroll(self.menu_adjustment,
+                    scroll)
+        if max_line > LAZY_MENU_THRESHOLD:
+            self.set_menu_model(
+                    LazyMenuModel(self.remote, folder, max_line, token))
+            if selected is not None and selected <= max_line:
+                self.menu_tree.get_selection().select_path(
+                        Gtk.TreePath((selected - 1,)))
+        else:
+            self.menu_inserter = MenuInserter(self.menu_tree, model, selected)
+            self.fetch_menu_page(token, model, folder, max_line, 1)
+
+    def set_menu_model(self, model):
+        # The tree view measures every row of a model, in the background,
+        # unless its height is fixed; for a lazy model, that would fetch
+        # every page.  With a fixed height, only the rows shown are asked.
+        lazy = isinstance(model, LazyMenuModel)
+        if not lazy:
+            self.menu_tree.set_fixed_height_mode(False)
+        self.menu_column.set_sizing(Gtk.TreeViewColumnSizing.FIXED if lazy
+                else Gtk.TreeViewColumnSizing.GROW_ONLY)
+        if lazy:
+            self.menu_tree.set_fixed_height_mode(True)
+        self.menu_tree.set_model(model)
+
+    def fetch_menu_page(self, token, model, folder, max_line, line):
+        # One job per page, so that user actions can run in between.
+        if line > max_line:
+            return
+        self.remote.call_async(self.remote.get_menu_page, folder, max_line,
+                line, priority=PRIORITY_MENU, token=token,
+                callback=lambda page: self.load_menu(token, model, folder,
+                    max_line, line, page),
+                error_callback=self.on_remote_error)
+
+    def load_menu(self, token, model, folder, max_line, line, page):
+        if page is None:
+            return
+        self.menu_inserter.add(page)
+        self.fetch_menu_page(token, model, folder, max_line, line + 8)
+
+    def on_menu_name(self, menu_name):
+        if not menu_name:
+            menu_name = self.remote.get_source()
+        if menu_name.startswith("- ") and menu_name.endswith(" -"):
+            menu_name = menu_name[2:-2]
+        self.current_button.set_label(menu_name)
+
+    def on_remote_error(self, error):
+        print >>sys.stderr, "Warning: %s" % error
+
+    def on_menu_changed(self, result):
+        self.update_menu()
+
+    def on_resume_menu_error(self, error):
+        if not isinstance(error, KeyError):
+            self.on_remote_error(error)
+        self.update_menu()
+
+    def cancel_menu(self):
+        """Abandon the requests still queued for the current menu."""
+        if self.menu_token is not None:
+            self.menu_token.cancel()
+            self.menu_token = None
+        if self.menu_inserter is not None:
+            self.menu_inserter.cancel()
+            self.menu_inserter = None
+        if self.menu_scroll_handler is not None:
+            if self.menu_scroll_handler[0] is not None:
+                self.menu_adjustment.disconnect(self.menu_scroll_handler[0])
+            self.menu_scroll_handler = None
+
+    def update_menu(self):
+        self.cancel_menu()
+        # Remembered so that reloading the same folder keeps the view.
+        self.menu_view = None
+        if self.menu_folder is not None:
+            old_model, selected_iter = \
+                    self.menu_tree.get_selection().get_selected()
+            selected = None
+            if selected_iter is not None:
+                selected = old_model[selected_iter][1]
+            self.menu_view = (self.menu_folder, selected,
+                    self.menu_adjustment.get_value())
+        self.menu_folder = None
+        model = Gtk.ListStore(str, int)
+        self.set_menu_model(model)
+
+        if self.remote.has_menu():
+            self.menu_box.show()
+            token = self.menu_token = CancellationToken()
+            self.remote.call_async(self.remote.get_menu_name,
+                    priority=PRIORITY_MENU, token=token,
+                    callback=self.on_menu_name,
+                    error_callback=self.on_remote_error)
+            self.remote.call_async(self.remote.get_menu_size,
+                    priority=PRIORITY_MENU, token=token,
+                    callback=lambda size: self.on_menu_size(token, model, size),
+                    error_callback=self.on_remote_error)
+        else:
+            self.menu_box.hide()
+
+    def on_menu_row_activated(self, tree, path, column):
+        model = tree.get_model()
+        menu_iter = model.get_iter(path)
+        if model[menu_iter][0] in ("", LazyMenuModel.PLACEHOLDER):
+            return
+        self.cancel_menu()
+        self.remote.sync.touch()
+        self.remote.call_async(self.remote.select_menu, model[menu_iter][1],
+                callback=self.on_menu_changed)
+
+    def on_parent_button_clicked(self, button):
+        self.cancel_menu()
+        self.remote.sync.touch()
+        self.remote.call_async(self.remote.menu_return,
+                callback=self.on_menu_changed)
+
+    def on_current_button_clicked(self, button):
+        button.handler_block_by_func(self.on_current_button_clicked)
+        button.set_active(True)
+        button.handler_unblock_by_func(self.on_current_button_clicked)
+
+    def on_index_button_clicked(self, button):
+        if button.get_active():
+            self.start_indexing()
+        else:
+            self.stop_indexing()
+
+    def start_indexing(self):
+        """Crawl the current source one folder at a time on the worker.
+
+        Each step is queued behind the user and sync requests, so the
+        receiver stays responsive.  The menu moves while it is crawled, so
+        it can not be browsed until the crawl is over.
+        """
+        self.cancel_menu()
+        self.menu_tree.set_sensitive(False)
+        self.parent_button.set_sensitive(False)
+        remote = self.remote
+        index = medialibrary.MediaIndex(
+                medialibrary.default_index_path(remote))
+        crawler = self.crawler = medialibrary.MediaCrawler(remote, index)
+        self.queue_index_step(crawler, crawler.steps())
+
+    def queue_index_step(self, crawler, steps):
+        crawler.remote.call_async(next, steps, None, priority=PRIORITY_MENU,
+                callback=lambda folder:
+                    self.on_index_step(crawler, steps, folder),
+                error_callback=lambda error:
+                    self.on_index_error(crawler, error))
+
+    def on_index_step(self, crawler, steps, folder):
+        # A cancelled crawl is still resumed until it has returned to the
+        # top menu.
+        if folder is not None:
+            self.queue_index_step(crawler, steps)
+        else:
+            self.on_index_done(crawler)
+
+    def on_index_error(self, crawler, error):
+        print >>sys.stderr, "Warning: indexing failed: %s" % error
+        self.on_index_done(crawler)
+
+    def on_index_done(self, crawler):
+        crawler.index.close()
+        if crawler is not self.crawler:
+            return
+        self.end_indexing()
+        # The crawl leaves the receiver at the top menu.
+        self.update_menu()
+
+    def stop_indexing(self):
+        """Cancel the crawl; it is over once back at the top menu."""
+        if self.crawler is not None:
+            self.crawler.cancel()
+            self.index_button.set_sensitive(False)
+
+    def end_indexing(self):
+        self.crawler = None
+        self.menu_tree.set_sensitive(True)
+        self.parent_button.set_sensitive(True)
+        self.index_button.set_sensitive(True)
+        self.index_button.handler_block_by_func(self.on_index_button_clicked)
+        self.index_button.set_active(False)
+        self.index_button.handler_unblock_by_func(self.on_index_button_clicked)
+
+    def on_repeat_button_clicked(self, button):
+        # Lazy me is lazy
+        repeat_mode = self.remote.get_repeat_mode()
+        modes = ["Off", "One", "All"]
+        index = (modes.index(repeat_mode) + 1) % 3
+        self.remote.sync.touch()
+        self.remote.set_repeat_mode(modes[index])
+
+    def on_remote_repeat_notify(self, remote, data):
+        repeat_mode = self.remote.get_repeat_mode()
+        self.repeat_button.handler_block_by_func(self.on_repeat_button_clicked)
+        self.repeat_button.set_active(repeat_mode != None and repeat_mode != "Off")
+        self.repeat_button.handler_unblock_by_func(self.on_repeat_button_clicked)
+        if repeat_mode == "One":
+            self.repeat_button.set_label("Repeat One")
+        elif repeat_mode == "All":
+            self.repeat_button.set_label("Repeat All")
+        else:
+            self.repeat_button.set_sensitive(repeat_mode is not None)
+            self.repeat_button.set_label("Repeat")
+
+    def on_shuffle_button_clicked(self, button):
+        # Lazy me is lazy
+        shuffle_mode = self.remote.get_shuffle_mode()
+        source = self.remote.get_source()
+        if source in ["SERVER", "USB", "NET RADIO"]:
+            modes = ["Off", "On"]
+        else:
+            # AirPlay, iPod_USB
+            modes = ["Off", "Songs", "Albums"]
+        index = (modes.index(shuffle_mode) + 1) % len(modes)
+        self.remote.sync.touch()
+        self.remote.set_shuffle_mode(modes[index])
+
+    def on_remote_shuffle_notify(self, remote, data):
+        shuffle_mode = self.remote.get_shuffle_mode()
+        self.shuffle_button.handler_block_by_func(self.on_shuffle_button_clicked)
+        self.shuffle_button.set_active(shuffle_mode != None and shuffle_mode != "Off")
+        self.shuffle_button.handler_unblock_by_func(self.on_shuffle_button_clicked)
+        if shuffle_mode == "Songs":
+            self.shuffle_button.set_label("Shuffle Songs")
+        elif shuffle_mode == "Albums":
+            self.shuffle_button.set_label("Shuffle Albums")
+        else:
+            self.shuffle_button.set_sensitive(shuffle_mode is not None)
+            self.shuffle_button.set_label("Shuffle")
+
+def on_activate(app):
+    windows = app.get_windows()
+    if len(windows) >= 1:
+        windows[0].present()
+
+def on_startup(app, watchdog):
+    settings = Gtk.Settings.get_default()
+    settings.set_property("gtk-application-prefer-dark-theme", True)
+
+    win = YamahaRemoteWindow()
+    win.set_application(app)
+    win.show_all()
+    if watchdog is not None:
+        for remote in win.group.remotes.values():
+            watchdog.watch(remote)
+
+def main(argv):
+    """Run the application.
+
+    Setting YAMAHAREMOTE_STALL_THRESHOLD to a number of milliseconds reports
+    the main loop stalls longer than that on stderr, and setting
+    YAMAHAREMOTE_PROFILE to a file name saves a cProfile of the session
+    there, for python -m pstats.
+    """
+    app = Gtk.Application(application_id="ca.deuxpi.YamahaRemote")
+    app.connect("activate", on_activate)
+    threshold = os.environ.get("YAMAHAREMOTE_STALL_THRESHOLD")
+
+    def run(argv):
+        # The watchdog is created here, below the profiler's frames, so
+        # that the first frame it samples is the handler.
+        watchdog = None
+        if threshold:
+            watchdog = StallWatchdog(float(threshold) / 1000)
+        app.connect("startup", on_startup, watchdog)
+        return app.run(argv)
+
+    profile = os.environ.get("YAMAHAREMOTE_PROFILE")
+    if not profile:
+        return run(argv)
+    import cProfile
+    profiler = cProfile.Profile()
+    try:
+        return profiler.runcall(run, argv)
+    finally:
+        profiler.dump_stats(profile)
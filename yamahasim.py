@@ -0,0 +1,448 @@
+#!/usr/bin/env python
+
+# Copyright (c) 2013 Philippe Gauthier
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""A local stand-in for a network-enabled Yamaha receiver.
+
+Serves /YamahaRemoteControl/ctrl well enough for YamahaRemoteControl to be
+exercised and benchmarked without hardware: Basic_Status, Input_Sel_Item,
+volume, mute and power of Main_Zone, Zone_2 and Zone_3, play mode,
+List_Info/List_Control browsing of synthetic folders of any size, with a
+configurable Busy period after each list operation and an injected latency
+per request, and Play_Info for the item last selected, whose tracks last
+track_length seconds, with its album art.
+"""
+
+import BaseHTTPServer
+import SocketServer
+import threading
+import time
+import xml.etree.ElementTree as ET
+
+LINES_PER_PAGE = 8
+ALBUM_ART_PATH = "/YamahaRemoteControl/AlbumART/AlbumART.ymf"
+
+class Folder(object):
+    """A menu folder.  Entries are sub-folders followed by size items."""
+
+    def __init__(self, name, folders=(), size=0, item_name="Track %d"):
+        self.name = name
+        self.folders = list(folders)
+        self.size = size
+        self.item_name = item_name
+
+    def __len__(self):
+        return len(self.folders) + self.size
+
+    def entry(self, index):
+        if index < len(self.folders):
+            return self.folders[index]
+        return self.item_name % (index - len(self.folders) + 1)
+
+def default_library(list_sizes=(10, 1000, 10000)):
+    """Build a media server tree with one folder per list size, plus a
+    small Artists/Album/Track hierarchy for deep navigation."""
+    folders = [Folder("%d Items" % size, size=size) for size in list_sizes]
+    artists = []
+    for a in range(1, 4):
+        albums = [Folder("Album %d-%d" % (a, b), size=10)
+                for b in range(1, 3)]
+        artists.append(Folder("Artist %d" % a, albums))
+    folders.append(Folder("Artists", artists))
+    return folders
+
+class Menu(object):
+    """Browsing state of one source."""
+
+    def __init__(self, name, folders):
+        self.stack = [Folder(name, folders)]
+        self.line = 1
+        self.lines = [1]
+        self.busy_until = 0.0
+        # (folder stack, item index, start time), or None.
+        self.playing = None
+
+    def folder(self):
+        return self.stack[-1]
+
+    def now_playing(self, track_length):
+        """Return (folder stack, item index, elapsed seconds), or None.
+
+        Playback moves on to the next item at the end of each track and
+        stops after the last one.
+        """
+        if self.playing is None:
+            return None
+        stack, index, start = self.playing
+        folder = stack[-1]
+        elapsed = time.time() - start
+        index += int(elapsed // track_length)
+        if index >= len(folder):
+            self.playing = None
+            return None
+        return stack, index, int(elapsed % track_length)
+
+class Zone(object):
+    """Settings of one zone."""
+
+    def __init__(self, power="Standby", volume=-400, mute="Off",
+            input="SERVER"):
+        self.power = power
+        self.volume = volume
+        self.mute = mute
+        self.input = input
+
+class Receiver(object):
+    """Receiver state, shared by all connections."""
+
+    # (Param, Src_Name, RW)
+    INPUTS = [
+        ("SERVER", "SERVER", "RW"),
+        ("NET RADIO", "NET_RADIO", "RW"),
+        ("USB", "USB", "RW"),
+        ("TUNER", "Tuner", "RW"),
+        ("AUDIO", "", "RW"),
+        ("V-AUX", "", "RW"),
+        ("Rhapsody", "Rhapsody", "R"),
+    ]
+
+    def __init__(self, list_sizes=(10, 1000, 10000), busy_delay=0.0,
+            latency=0.0, batching=True, track_length=180):
+        self.lock = threading.RLock()
+        self.busy_delay = busy_delay
+        self.track_length = track_length
+        self.latency = latency
+        self.batching = batching
+        self.request_count = 0
+        self.art_count = 0
+        self.network_name = "RX-SIM"
+        self.zones = {
+            "Main_Zone": Zone("On"),
+            "Zone_2": Zone(),
+            "Zone_3": Zone(),
+        }
+        self.play_modes = {}
+        self.list_sizes = list_sizes
+        self.reset_menus()
+
+    def reset_menus(self):
+        with self.lock:
+            self.menus = {
+                "SERVER": Menu("SERVER", default_library(self.list_sizes)),
+                "USB": Menu("USB", default_library(self.list_sizes)),
+                "NET_RADIO": Menu("NET RADIO",
+                    [Folder("Stations", size=50, item_name="Station %d")]),
+            }
+
+    def src_names(self):
+        return dict((param, name) for param, name, rw in self.INPUTS)
+
+    def handle(self, body):
+        if self.latency:
+            time.sleep(self.latency)
+        with self.lock:
+            self.request_count += 1
+            request = ET.fromstring(body)
+            cmd = request.get("cmd")
+            response = ET.Element("YAMAHA_AV", rsp=cmd, RC="0")
+            try:
+                leaves = []
+                self._walk(request, response, [], leaves)
+                if cmd == "GET" and len(leaves) > 1 and not self.batching:
+                    raise KeyError("/".join(leaves[1][0]))
+                for path, element in leaves:
+                    if cmd == "GET":
+                        self._get(path, element)
+                    else:
+                        self._put(path, element)
+            except (KeyError, IndexError, ValueError):
+                response = ET.Element("YAMAHA_AV", rsp=cmd, RC="2")
+                for child in request:
+                    ET.SubElement(response, child.tag)
+            return ET.tostring(response, encoding="utf-8")
+
+    def _walk(self, request, response, path, leaves):
+        for child in request:
+            element = ET.SubElement(response, child.tag)
+            child_path = path + [child.tag]
+            if len(child):
+                self._walk(child, element, child_path, leaves)
+            else:
+                element.text = child.text
+                leaves.append((child_path, element))
+
+    def _menu(self, src_name):
+        return self.menus[src_name]
+
+    def _get(self, path, element):
+        key = "/".join(path)
+        element.text = None
+        if key == "System/Misc/Network/Network_Name":
+            element.text = self.network_name
+        elif path[0] in self.zones:
+            self._get_zone(self.zones[path[0]], path[1:], element)
+        elif path[1:] == ["List_Info"]:
+            self._get_list_info(self._menu(path[0]), element)
+        elif path[1] == "Play_Info" and len(path) <= 3:
+            self._get_play_info(self._menu(path[0]), path[2:], element)
+        elif path[1:3] == ["Play_Control", "Play_Mode"] and len(path) == 4:
+            element.text = self.play_modes.get((path[0], path[3]), "Off")
+        else:
+            raise KeyError(key)
+
+    def _level(self, zone, element):
+        ET.SubElement(element, "Val").text = str(zone.volume)
+        ET.SubElement(element, "Exp").text = "1"
+        ET.SubElement(element, "Unit").text = "dB"
+
+    def _get_zone(self, zone, path, element):
+        key = "/".join(path)
+        if key == "Basic_Status":
+            power = ET.SubElement(element, "Power_Control")
+            ET.SubElement(power, "Power").text = zone.power
+            ET.SubElement(power, "Sleep").text = "Off"
+            volume = ET.SubElement(element, "Volume")
+            self._level(zone, ET.SubElement(volume, "Lvl"))
+            ET.SubElement(volume, "Mute").text = zone.mute
+            inp = ET.SubElement(element, "Input")
+            ET.SubElement(inp, "Input_Sel").text = zone.input
+        elif key == "Volume/Lvl":
+            self._level(zone, element)
+        elif key == "Volume/Mute":
+            element.text = zone.mute
+        elif key == "Power_Control/Power":
+            element.text = zone.power
+        elif key == "Input/Input_Sel":
+            element.text = zone.input
+        elif key == "Input/Input_Sel_Item":
+            for i, (param, name, rw) in enumerate(self.INPUTS):
+                item = ET.SubElement(element, "Item_%d" % (i + 1))
+                ET.SubElement(item, "Param").text = param
+                ET.SubElement(item, "RW").text = rw
+                ET.SubElement(item, "Title").text = param
+                ET.SubElement(item, "Src_Name").text = name
+                ET.SubElement(item, "Src_Number").text = "1"
+        else:
+            raise KeyError(key)
+
+    def _get_list_info(self, menu, element):
+        folder = menu.folder()
+        ready = time.time() >= menu.busy_until
+        ET.SubElement(element, "Menu_Status").text = ["Busy", "Ready"][ready]
+        ET.SubElement(element, "Menu_Layer").text = str(len(menu.stack))
+        ET.SubElement(element, "Menu_Name").text = folder.name
+        current = ET.SubElement(element, "Current_List")
+        first = (menu.line - 1) // LINES_PER_PAGE * LINES_PER_PAGE + 1
+        for i in range(LINES_PER_PAGE):
+            line = ET.SubElement(current, "Line_%d" % (i + 1))
+            index = first + i - 1
+            if index < len(folder):
+                entry = folder.entry(index)
+                if isinstance(entry, Folder):
+                    text, attribute = entry.name, "Container"
+                else:
+                    text, attribute = entry, "Item"
+            else:
+                text, attribute = None, "Unselectable"
+            ET.SubElement(line, "Txt").text = text
+            ET.SubElement(line, "Attribute").text = attribute
+        cursor = ET.SubElement(element, "Cursor_Position")
+        ET.SubElement(cursor, "Current_Line").text = str(menu.line)
+        ET.SubElement(cursor, "Max_Line").text = str(len(folder))
+
+    PLAY_INFO_NODES = ["Feature_Availability", "Playback_Info", "Meta_Info",
+            "Play_Time", "Album_ART"]
+
+    def _get_play_info(self, menu, path, element):
+        """Fill in Play_Info, or the one node of it in path."""
+        if path and path[0] not in self.PLAY_INFO_NODES:
+            raise KeyError("/".join(path))
+        playing = menu.now_playing(self.track_length)
+        for name in self.PLAY_INFO_NODES:
+            if path and path[0] != name:
+                continue
+            node = element if path else ET.SubElement(element, name)
+            if name == "Feature_Availability":
+                node.text = "Ready"
+            elif name == "Playback_Info":
+                node.text = "Stop" if playing is None else "Play"
+            elif name == "Meta_Info":
+                artist = album = song = None
+                if playing is not None:
+                    stack, index, elapsed = playing
+                    album = stack[-1].name
+                    if len(stack) > 2:
+                        artist = stack[-2].name
+                    song = stack[-1].entry(index)
+                ET.SubElement(node, "Artist").text = artist
+                ET.SubElement(node, "Album").text = album
+                ET.SubElement(node, "Song").text = song
+            elif name == "Play_Time":
+                elapsed = playing[2] if playing is not None else 0
+                elapsed_node = ET.SubElement(node, "Elapsed")
+                ET.SubElement(elapsed_node, "Hour").text = str(elapsed // 3600)
+                ET.SubElement(elapsed_node, "Min").text = str(elapsed // 60 % 60)
+                ET.SubElement(elapsed_node, "Sec").text = str(elapsed % 60)
+            elif name == "Album_ART":
+                art_id = self._album_art_id(playing)
+                ET.SubElement(node, "URL").text = \
+                        ALBUM_ART_PATH if art_id else None
+                ET.SubElement(node, "ID").text = str(art_id)
+                ET.SubElement(node, "Format").text = "YMF"
+
+    def _album_art_id(self, playing):
+        # One cover per album folder; 0 when nothing is playing.
+        if playing is None:
+            return 0
+        return id(playing[0][-1]) % 100000 + 1
+
+    def get_album_art(self):
+        """Return the cover of what the current input plays, or None."""
+        with self.lock:
+            src_name = self.src_names().get(self.zones["Main_Zone"].input)
+            if src_name not in self.menus:
+                return None
+            self.art_count += 1
+            playing = self.menus[src_name].now_playing(self.track_length)
+            art_id = self._album_art_id(playing)
+            if not art_id:
+                return None
+            return "YMF\0cover %d" % art_id
+
+    def _put(self, path, element):
+        key = "/".join(path)
+        value = element.text
+        element.text = None
+        if path[0] in self.zones:
+            self._put_zone(self.zones[path[0]], path[1:], value)
+        elif path[1:3] == ["Play_Control", "Play_Mode"] and len(path) == 4:
+            self.play_modes[(path[0], path[3])] = value
+        elif path[1] == "List_Control":
+            self._put_list_control(self._menu(path[0]), path[2], value)
+        else:
+            raise KeyError(key)
+
+    def _put_zone(self, zone, path, value):
+        key = "/".join(path)
+        if key == "Power_Control/Power":
+            zone.power = value
+        elif key == "Volume/Lvl/Val":
+            zone.volume = int(value)
+        elif key in ("Volume/Lvl/Exp", "Volume/Lvl/Unit"):
+            pass
+        elif key == "Volume/Mute":
+            zone.mute = value
+        elif key == "Input/Input_Sel":
+            if value not in self.src_names():
+                raise ValueError(value)
+            zone.input = value
+        else:
+            raise KeyError(key)
+
+    def _put_list_control(self, menu, control, value):
+        folder = menu.folder()
+        if control == "Jump_Line":
+            menu.line = max(1, min(int(value), max(len(folder), 1)))
+        elif control == "Direct_Sel":
+            first = (menu.line - 1) // LINES_PER_PAGE * LINES_PER_PAGE + 1
+            index = first + int(value[len("Line_"):]) - 2
+            entry = folder.entry(index)
+            if isinstance(entry, Folder):
+                menu.lines[-1] = menu.line
+                menu.stack.append(entry)
+                menu.lines.append(1)
+                menu.line = 1
+            else:
+                menu.playing = (list(menu.stack), index, time.time())
+        elif control == "Cursor" and value == "Return":
+            if len(menu.stack) > 1:
+                menu.stack.pop()
+                menu.lines.pop()
+                menu.line = menu.lines[-1]
+        else:
+            raise KeyError(control)
+        menu.busy_until = time.time() + self.busy_delay
+
+class RequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Send each response in one segment, as a receiver would.
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        body = None
+        if self.path == ALBUM_ART_PATH:
+            body = self.server.receiver.get_album_art()
+        if body is None:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        if self.path != "/YamahaRemoteControl/ctrl":
+            self.send_error(404)
+            return
+        length = int(self.headers.getheader("Content-Length", 0))
+        body = self.server.receiver.handle(self.rfile.read(length))
+        self.send_response(200)
+        self.send_header("Content-Type", 'text/xml; charset="utf-8"')
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+class ReceiverServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, receiver, address=("127.0.0.1", 0)):
+        BaseHTTPServer.HTTPServer.__init__(self, address, RequestHandler)
+        self.receiver = receiver
+
+    def get_address(self):
+        """Return the address to give to YamahaRemoteControl."""
+        return "%s:%d" % self.server_address
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+if __name__ == '__main__':
+    import optparse
+    parser = optparse.OptionParser(usage="%prog [options]")
+    parser.add_option("--port", type="int", default=8080)
+    parser.add_option("--latency", type="float", default=0.0,
+            help="delay added to every request, in seconds")
+    parser.add_option("--busy-delay", type="float", default=0.0,
+            help="time the menu stays Busy after a list operation")
+    parser.add_option("--no-batching", action="store_true",
+            help="reject GET requests for more than one node")
+    options, args = parser.parse_args()
+    receiver = Receiver(busy_delay=options.busy_delay,
+            latency=options.latency, batching=not options.no_batching)
+    server = ReceiverServer(receiver, ("127.0.0.1", options.port))
+    print "Serving on %s" % server.get_address()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
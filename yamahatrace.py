@@ -0,0 +1,229 @@
+# Copyright (c) 2013 Philippe Gauthier
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Recording and replay of the traffic between the remote and receivers.
+
+A trace is an append-only file with one JSON object per exchange:
+
+    {"a": address, "t": start time, "cmd": "GET" or "PUT",
+     "req": request document, "rsp": response body, "rc": RC code,
+     "connect": connect time, "total": total time, "conns": new connections,
+     "err": [pycurl error code, message]}
+
+Bodies are stored as Latin-1 so that the exact bytes come back.  "rsp" and
+"rc" are absent when the transfer failed, and "err" is only present then.
+Files whose name ends in .gz are compressed; those of a process that did not
+exit cleanly lack the gzip trailer but can still be loaded.
+
+RecordingTransport wraps the transport of a YamahaRemoteControl to write
+such a file, and ReplayTransport stands in for it to answer from one.
+"""
+
+import atexit
+import collections
+import gzip
+import json
+import re
+import threading
+import time
+import zlib
+
+import pycurl
+
+RC_RE = re.compile(r'<YAMAHA_AV[^>]* RC="(\d+)"')
+
+def _open(path, mode):
+    if path.endswith(".gz"):
+        return gzip.open(path, mode)
+    return open(path, mode)
+
+class TraceRecorder(object):
+    """Appends exchanges to a trace file.  Safe to share between threads."""
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.file = _open(path, "ab")
+
+    def write(self, entry):
+        line = json.dumps(entry, separators=(",", ":")) + "\n"
+        with self.lock:
+            self.file.write(line)
+            # A trace is most useful right after something went wrong.
+            if isinstance(self.file, gzip.GzipFile):
+                self.file.flush(zlib.Z_SYNC_FLUSH)
+            else:
+                self.file.flush()
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+_recorders = {}
+_recorders_lock = threading.Lock()
+
+def get_recorder(path):
+    """Return the recorder of path, shared by all remotes of the process."""
+    with _recorders_lock:
+        recorder = _recorders.get(path)
+        if recorder is None:
+            recorder = _recorders[path] = TraceRecorder(path)
+        return recorder
+
+@atexit.register
+def close_recorders():
+    with _recorders_lock:
+        for recorder in _recorders.values():
+            recorder.close()
+        _recorders.clear()
+
+class RecordingTransport(object):
+    """Records every exchange made through another transport."""
+
+    def __init__(self, transport, recorder):
+        self.transport = transport
+        self.recorder = recorder
+        self.address = transport.address
+
+    @property
+    def online(self):
+        return self.transport.online
+
+    def perform(self, cmd, req):
+        entry = {"a": self.address, "t": time.time(), "cmd": cmd,
+                "req": req.decode("latin-1")}
+        try:
+            body = self.transport.perform(cmd, req)
+        except pycurl.error, e:
+            entry["err"] = list(e.args)
+            if getattr(e, "sent", True):
+                entry.update(self._timings())
+            else:
+                # ReceiverOfflineError: nothing was sent.
+                entry.update({"connect": 0.0, "total": 0.0, "conns": 0})
+            self.recorder.write(entry)
+            raise
+        match = RC_RE.search(body)
+        entry.update({
+            "rsp": body.decode("latin-1"),
+            "rc": int(match.group(1)) if match else None,
+        })
+        entry.update(self._timings())
+        self.recorder.write(entry)
+        return body
+
+    def _timings(self):
+        return {
+            "connect": self.transport.getinfo(pycurl.CONNECT_TIME),
+            "total": self.transport.getinfo(pycurl.TOTAL_TIME),
+            "conns": self.transport.getinfo(pycurl.NUM_CONNECTS),
+        }
+
+    def getinfo(self, info):
+        return self.transport.getinfo(info)
+
+    def probe(self):
+        return self.transport.probe()
+
+    def fetch(self, path):
+        # Files such as album art are not part of the trace.
+        return self.transport.fetch(path)
+
+    def close(self):
+        self.transport.close()
+
+def load_trace(path, address=None):
+    """Return the exchanges of a trace, optionally only those of address."""
+    entries = []
+    with _open(path, "rb") as f:
+        try:
+            for line in f:
+                if not line.strip():
+                    continue
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # The last line of an interrupted recording.
+                    break
+                if address is None or entry.get("a") == address:
+                    entries.append(entry)
+        except (IOError, EOFError):
+            # A compressed trace without its trailer.
+            pass
+    return entries
+
+class ReplayTransport(object):
+    """Answers requests from a trace instead of a receiver.
+
+    Each request document is answered with the responses recorded for the
+    same document, in recorded order; once they are used up, the last one
+    is repeated, which suits status polls.  A document that was never
+    recorded fails like an unreachable receiver.  Recorded transfer errors
+    are raised again.
+
+    With speed None, answers come as fast as possible; otherwise each takes
+    its recorded total time divided by speed.  One transport can be shared
+    by several remotes, when they replay a session in the same order it
+    was recorded.
+    """
+
+    def __init__(self, entries, speed=None, address="replay"):
+        self.address = address
+        self.speed = speed
+        self.online = True
+        self.lock = threading.Lock()
+        self.responses = collections.defaultdict(collections.deque)
+        for entry in entries:
+            self.responses[entry["req"].encode("latin-1")].append(entry)
+        self.last = {}
+        self.info = {}
+        self.request_count = 0
+        self.missing = collections.Counter()
+
+    def perform(self, cmd, req):
+        with self.lock:
+            self.request_count += 1
+            queue = self.responses.get(req)
+            if queue:
+                entry = self.last[req] = queue.popleft()
+            else:
+                entry = self.last.get(req)
+            if entry is None:
+                self.missing[req] += 1
+        if entry is None:
+            raise pycurl.error(pycurl.E_COULDNT_CONNECT,
+                    "request not in trace")
+        if self.speed:
+            time.sleep(entry.get("total", 0.0) / self.speed)
+        if "err" in entry:
+            raise pycurl.error(*entry["err"])
+        self.info = {
+            pycurl.CONNECT_TIME: entry.get("connect", 0.0),
+            pycurl.TOTAL_TIME: entry.get("total", 0.0),
+            pycurl.NUM_CONNECTS: entry.get("conns", 0),
+        }
+        return entry["rsp"].encode("latin-1")
+
+    def getinfo(self, info):
+        return self.info.get(info, 0)
+
+    def probe(self):
+        return True
+
+    def fetch(self, path):
+        return None
+
+    def close(self):
+        pass